@@ -0,0 +1,316 @@
+'''
+Humidity Controller benchmarks
+
+Measures the paths that matter under load, all without hardware:
+
+    sensor    HTU21D read latency against a simulated bus
+    insert    data log insert throughput for different commit policies,
+              and for the samplelog.py backend
+    rows      get_rows / get_range latency as the data log grows
+    web       / and /data latency and throughput with concurrent clients
+
+Results are written as JSON so runs from different versions can be
+compared:
+
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -o after.json --compare before.json
+
+Use --quick for a fast smoke run and --only to pick benchmarks.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, 'htu21d_py3'))
+
+import datalog
+import ringbuffer
+import samplelog
+import htu21d.htu21d as htu
+from htu21d.simulated import SimulatedHTU21DBus, ConstantEnvironment
+
+
+def percentiles(samples):
+    """Summary statistics of a list of durations in seconds."""
+    samples = sorted(samples)
+    n = len(samples)
+
+    def pct(p):
+        return samples[min(n - 1, int(p / 100.0 * n))]
+
+    return {
+        'n': n,
+        'mean': sum(samples) / n,
+        'min': samples[0],
+        'p50': pct(50),
+        'p90': pct(90),
+        'p99': pct(99),
+        'max': samples[-1],
+    }
+
+
+def timed(fn, repeat):
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def synthetic_rows(count, start_ms=1500000000000, period_ms=2000, seed=1):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield (start_ms + i * period_ms, 20 + rng.random() * 5,
+               80 + rng.random() * 15, 92.0, 0)
+
+
+def bench_sensor(args):
+    results = {}
+    env = ConstantEnvironment(22.5, 88.0)
+    for scale in (0.0, 1.0):
+        for mode_name, mode in (('noholdmaster', htu.HTU21D_NOHOLDMASTER),
+                                ('holdmaster', htu.HTU21D_HOLDMASTER)):
+            for persistent in (False, True):
+                bus = SimulatedHTU21DBus(env, conversion_scale=scale)
+                sensor = htu.HTU21D(mode=mode, persistent=persistent, bus=bus)
+                repeat = args.repeat if scale == 0.0 else max(5, args.repeat // 20)
+                name = '{}/scale={}/{}'.format(mode_name, scale,
+                                               'persistent' if persistent else 'reopen')
+                results[name + '/read_temperature'] = timed(sensor.read_temperature, repeat)
+                results[name + '/read_humidity'] = timed(sensor.read_humidity, repeat)
+                results[name + '/read_all'] = timed(sensor.read_all, repeat)
+    return results
+
+
+def bench_insert(args, tmpdir):
+    results = {}
+    count = 2000 if args.quick else 20000
+
+    # One commit per sample on the caller's thread, like the original add_data.
+    for synchronous in ('FULL', 'NORMAL'):
+        path = os.path.join(tmpdir, 'insert-direct-{}.db'.format(synchronous))
+        conn = datalog.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous={}".format(synchronous))
+        n = count // 10
+        start = time.perf_counter()
+        for row in synthetic_rows(n):
+            datalog.add_data(conn, *row[1:4], ts=row[0])
+            conn.commit()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        results['commit_per_sample/synchronous={}'.format(synchronous)] = {
+            'samples': n, 'seconds': elapsed, 'samples_per_second': n / elapsed}
+
+    # DataWriter group commits; add() latency is what the control loop sees.
+    for batch_size in (1, 30, 300):
+        for synchronous in ('FULL', 'NORMAL'):
+            path = os.path.join(tmpdir, 'insert-writer-{}-{}.db'.format(batch_size, synchronous))
+            datalog.connect(path).close()
+            writer = datalog.DataWriter(path, batch_size=batch_size, flush_interval=1.0,
+                                        max_pending=count, synchronous=synchronous)
+            writer.start()
+            add = []
+            start = time.perf_counter()
+            for row in synthetic_rows(count):
+                t = time.perf_counter()
+                writer.add(*row[1:4], ts=row[0])
+                add.append(time.perf_counter() - t)
+            writer.close()
+            elapsed = time.perf_counter() - start
+            results['writer/batch={}/synchronous={}'.format(batch_size, synchronous)] = {
+                'samples': count, 'seconds': elapsed,
+                'samples_per_second': count / elapsed, 'commits': writer.commits,
+                'dropped': writer.dropped, 'add_latency': percentiles(add)}
+
+    # Memory-mapped sample log, flushed once at the end.
+    store = samplelog.SampleLogStore(os.path.join(tmpdir, 'insert-samplelog'))
+    add = []
+    start = time.perf_counter()
+    for row in synthetic_rows(count):
+        t = time.perf_counter()
+        store.add(*row[1:4], ts=row[0])
+        add.append(time.perf_counter() - t)
+    store.close()
+    elapsed = time.perf_counter() - start
+    results['samplelog'] = {
+        'samples': count, 'seconds': elapsed,
+        'samples_per_second': count / elapsed, 'add_latency': percentiles(add)}
+    return results
+
+
+def bench_rows(args, tmpdir):
+    results = {}
+    sizes = (10000, 100000) if args.quick else (10000, 100000, 1000000, 3000000)
+    path = os.path.join(tmpdir, 'rows.db')
+    conn = datalog.connect(path)
+    log = samplelog.SampleLog(os.path.join(tmpdir, 'rows.samples'), grow=50000)
+    rows = synthetic_rows(sizes[-1])
+    have = 0
+    for size in sizes:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            have += 1
+            if len(chunk) == 50000 or have == size:
+                with conn:
+                    datalog.insert_samples(conn, chunk)
+                for sample in chunk:
+                    log.append(*sample[:4])
+                chunk = []
+            if have == size:
+                break
+        last = 1500000000000 + (size - 1) * 2000
+        results['get_rows/rows={}'.format(size)] = timed(
+            lambda: datalog.get_rows(conn), args.repeat)
+        results['get_range/1h/rows={}'.format(size)] = timed(
+            lambda: datalog.get_range(conn, last - 3600 * 1000), args.repeat)
+        results['get_rollups/1h/30d/rows={}'.format(size)] = timed(
+            lambda: datalog.get_rollups(conn, datalog.ROLLUP_1H, last - 30 * 86400 * 1000),
+            args.repeat)
+        results['db_bytes/rows={}'.format(size)] = os.path.getsize(path)
+        results['samplelog/get_rows/rows={}'.format(size)] = timed(
+            lambda: log.rows(limit=1000), args.repeat)
+        results['samplelog/get_range/1h/rows={}'.format(size)] = timed(
+            lambda: log.rows(last - 3600 * 1000), args.repeat)
+    conn.close()
+    log.close()
+    return results
+
+
+def bench_web(args):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import webpage.app as app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    ring = ringbuffer.SampleRing(1000)
+    ring.extend(synthetic_rows(1000))
+    server = make_server('127.0.0.1', 0, app.create_app({'main': ring}), threaded=True,
+                         request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    cursor = ring.rows()[-2][0]
+
+    def fetch(path):
+        start = time.perf_counter()
+        with urllib.request.urlopen(base + path) as response:
+            body = response.read()
+        return time.perf_counter() - start, len(body)
+
+    results = {}
+    requests = 50 if args.quick else 400
+    for path in ('/', '/data', '/data?since={}'.format(cursor), '/data?format=binary',
+                 '/data?derived=dewpoint,absolute_humidity,vpd'):
+        for clients in (1, 8, 32):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                responses = list(pool.map(fetch, [path] * requests))
+            elapsed = time.perf_counter() - start
+            entry = percentiles([r[0] for r in responses])
+            entry['requests_per_second'] = requests / elapsed
+            entry['bytes'] = responses[0][1]
+            results['{}/clients={}'.format(path, clients)] = entry
+    server.shutdown()
+    return results
+
+
+BENCHMARKS = ('sensor', 'insert', 'rows', 'web')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '/'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(new, old):
+    """Prints new/old ratios for every metric both runs have."""
+    new_flat = flatten(new['results'])
+    old_flat = flatten(old['results'])
+    for name in sorted(set(new_flat) & set(old_flat)):
+        if old_flat[name]:
+            print('{:8.2f}x  {}'.format(new_flat[name] / old_flat[name], name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write JSON results here (default stdout)')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--quick', action='store_true', help='small sizes for a smoke run')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat = min(args.repeat, 20)
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': datalog.sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+        },
+        'results': {},
+    }
+    # Keep stdout for the JSON report.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.only:
+            print('Running {} benchmarks...'.format(name), file=sys.stderr)
+            if name == 'sensor':
+                report['results'][name] = bench_sensor(args)
+            elif name == 'insert':
+                report['results'][name] = bench_insert(args, tmpdir)
+            elif name == 'rows':
+                report['results'][name] = bench_rows(args, tmpdir)
+            elif name == 'web':
+                report['results'][name] = bench_web(args)
+    sys.stdout = stdout
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
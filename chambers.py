@@ -0,0 +1,206 @@
+'''
+Chamber configuration for the humidity controller.
+
+Each chamber has its own HTU21D (I2C bus and address, optionally behind
+a channel of a TCA9548A multiplexer), relay and fan pins and humidity
+setpoints. Chambers are listed in a JSON file:
+
+    {"chambers": [
+        {"name": "left", "bus": 1, "relay_pin": 23, "fan_pin": 18},
+        {"name": "right", "bus": 3, "relay_pin": 25, "fan_pin": 12,
+         "setpoint_low": 80, "setpoint_high": 88},
+        {"name": "shelf", "bus": 1, "mux_address": 112, "mux_channel": 2,
+         "relay_pin": 5, "fan_pin": 6},
+        {"name": "tent", "bus": 4, "relay_pin": 24, "fan_pin": 13,
+         "control": "pid", "setpoint": 88}
+    ]}
+
+control is "hysteresis" (the default: fogger and fan on below
+setpoint_low, off above setpoint_high) or "pid", which holds setpoint
+(by default halfway between the two) with a time-proportioned fogger and
+a PWM fan, see control.py. kp, ki and kd are its gains per %RH, the
+fogger runs once per fog_period seconds for at least min_on and rests
+for at least min_off seconds, and fan_split is the output above which
+the fan speeds up. PID chambers need their fan on a hardware PWM pin.
+"predictive" switches like hysteresis, but early, from a model of the
+chamber fitted to the last model_window seconds of samples with a dead
+time of up to max_dead_time seconds.
+
+Readings are filtered (see filters.py) with a running median of the last
+filter_window readings followed by an exponential moving average giving
+each new reading weight filter_alpha. With oversample above 1 the sensor
+is read that many times back to back per sample, all through the filter.
+
+Sensors are sampled every sample_period seconds at resolution, one of
+RH12_T14 (the sensor's default, slowest), RH11_T11, RH10_T13 or RH8_T12
+(about 16 ms a reading). For fast sampling, at 5 to 10 Hz to tune the
+response of a chamber, set log_interval as well: control still acts on
+every sample, but only the means over each log_interval seconds are
+logged and stored, so the database sees no more writes than usual:
+
+    {"name": "tent", "sample_period": 0.1, "resolution": "RH8_T12",
+     "log_interval": 1.0}
+
+Anything a chamber leaves out comes from the defaults passed to
+load_config(), which humidity_controller.py fills from its constants.
+'''
+import fcntl
+import json
+import os
+import threading
+
+import htu21d.htu21d as htu
+
+
+class ChamberConfig(object):
+    DEFAULTS = {
+        'name': 'main',
+        'bus': htu.I2C_BUS,
+        'address': htu.HTU21D_I2CADDR,
+        'mux_address': None,
+        'mux_channel': None,
+        'relay_pin': 23,
+        'fan_pin': 18,
+        'setpoint_low': 85,
+        'setpoint_high': 92,
+        'control': 'hysteresis',
+        'setpoint': None,
+        'kp': 0.05,
+        'ki': 0.0001,
+        'kd': 0.0,
+        'fog_period': 300.0,
+        'min_on': 10.0,
+        'min_off': 20.0,
+        'fan_split': 0.5,
+        'model_window': 1800.0,
+        'max_dead_time': 120.0,
+        'filter_window': 3,
+        'filter_alpha': 0.5,
+        'oversample': 1,
+        'sample_period': 2.0,
+        'resolution': 'RH12_T14',
+        'log_interval': None,
+    }
+    CONTROLS = ('hysteresis', 'pid', 'predictive')
+    RESOLUTIONS = {
+        'RH12_T14': htu.HTU21D_RES_RH12_T14,
+        'RH11_T11': htu.HTU21D_RES_RH11_T11,
+        'RH10_T13': htu.HTU21D_RES_RH10_T13,
+        'RH8_T12': htu.HTU21D_RES_RH8_T12,
+    }
+
+    def __init__(self, **settings):
+        unknown = set(settings) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown chamber settings: {}'.format(', '.join(sorted(unknown))))
+        for key, default in self.DEFAULTS.items():
+            setattr(self, key, settings.get(key, default))
+        if (self.mux_address is None) != (self.mux_channel is None):
+            raise ValueError('Chamber {}: set both mux_address and mux_channel, or neither.'
+                             .format(self.name))
+        if self.control not in self.CONTROLS:
+            raise ValueError('Chamber {}: control must be one of {}, not {!r}'
+                             .format(self.name, ', '.join(self.CONTROLS), self.control))
+        if self.oversample < 1 or self.filter_window < 1 or not 0 < self.filter_alpha <= 1:
+            raise ValueError('Chamber {}: oversample and filter_window must be at least 1 and'
+                             ' filter_alpha between 0 and 1.'.format(self.name))
+        if self.resolution not in self.RESOLUTIONS:
+            raise ValueError('Chamber {}: resolution must be one of {}, not {!r}'
+                             .format(self.name, ', '.join(sorted(self.RESOLUTIONS)),
+                                     self.resolution))
+        if self.sample_period <= 0 or (self.log_interval is not None and self.log_interval <= 0):
+            raise ValueError('Chamber {}: sample_period and log_interval must be positive.'
+                             .format(self.name))
+        if not 0 < self.fan_split < 1:
+            raise ValueError('Chamber {}: fan_split must be between 0 and 1, not {!r}'
+                             .format(self.name, self.fan_split))
+        if self.setpoint is None:
+            self.setpoint = (self.setpoint_low + self.setpoint_high) / 2.0
+
+    def __repr__(self):
+        return 'ChamberConfig({})'.format(', '.join(
+            '{}={!r}'.format(key, getattr(self, key)) for key in sorted(self.DEFAULTS)))
+
+
+def load_config(path=None, **defaults):
+    """The configured chambers. Without a config file there is one chamber
+    made of the defaults."""
+    if path is None:
+        return [ChamberConfig(**defaults)]
+
+    with open(path) as f:
+        config = json.load(f)
+    chambers = []
+    for entry in config['chambers']:
+        settings = dict(defaults)
+        settings.update(entry)
+        chambers.append(ChamberConfig(**settings))
+
+    names = [c.name for c in chambers]
+    if len(set(names)) != len(names):
+        raise ValueError('Chamber names must be unique: {}'.format(names))
+    pins = [p for c in chambers for p in (c.relay_pin, c.fan_pin)]
+    if len(set(pins)) != len(pins):
+        raise ValueError('Chambers must not share relay or fan pins: {}'.format(pins))
+    return chambers
+
+
+class TCA9548A(object):
+    """TCA9548A I2C multiplexer. select() routes the bus to one channel."""
+
+    def __init__(self, busnum, address=0x70):
+        self._busnum = busnum
+        self._address = address
+        self._fd = None
+        self._channel = None
+
+    def select(self, channel):
+        if channel == self._channel:
+            return
+        if self._fd is None:
+            self._fd = os.open('/dev/i2c-{}'.format(self._busnum), os.O_RDWR)
+            fcntl.ioctl(self._fd, htu.I2C_SLAVE, self._address)
+        os.write(self._fd, bytes(bytearray([1 << channel])))
+        self._channel = channel
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._channel = None
+
+
+class SensorBus(object):
+    """Serialises the sensors sharing one I2C bus.
+
+    Sensors on different buses are read concurrently; sensors on the same
+    bus take turns, with the multiplexer (if any) switched to the right
+    channel first.
+    """
+
+    def __init__(self, busnum, mux_factory=TCA9548A):
+        self.busnum = busnum
+        self.lock = threading.Lock()
+        self._mux_factory = mux_factory
+        self._muxes = {}
+
+    def mux(self, address):
+        if address not in self._muxes:
+            self._muxes[address] = self._mux_factory(self.busnum, address)
+        return self._muxes[address]
+
+    def _select(self, config):
+        if config.mux_address is not None:
+            self.mux(config.mux_address).select(config.mux_channel)
+
+    def configure(self, sensor, config):
+        """Sets sensor to the configured resolution."""
+        with self.lock:
+            self._select(config)
+            sensor.set_resolution(config.RESOLUTIONS[config.resolution])
+
+    def read(self, sensor, config):
+        """(temperature, humidity, dewpoint) from sensor."""
+        with self.lock:
+            self._select(config)
+            return sensor.read_all()
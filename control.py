@@ -0,0 +1,445 @@
+'''
+Proportional humidity control.
+
+Instead of switching the fogger and fan fully on below setpoint_low and
+off above setpoint_high, a PID loop works out how much fog the chamber
+needs, from 0 to 1, and two actuators deliver it:
+
+- the fogger relay is time-proportioned (TimeProportioner): switched on
+  for that fraction of every fog period, but never for less than min_on
+  or off for less than min_off seconds, to spare the relay and fogger;
+- the recirculation fan on a hardware PWM pin (HardwarePWM) sets how
+  fast the fog is blown into the chamber while the fogger runs.
+
+split() shares the output between them: up to fan_split only the fogger
+duty rises, with the fan off; beyond it the fogger stays on
+and the fan speeds up. Fog delivered slowly over a long on time swings
+the humidity less than the same fog in a short burst, so the fan only
+runs fast when the fogger alone cannot keep up.
+
+Predictive control keeps the on/off switching of hysteresis but
+switches early: fit_fopdt() fits a first order plus dead time model of
+the chamber to the recent samples and relay states, and the relay goes
+off as soon as the fog already on its way is predicted to carry the
+humidity to setpoint_high, and on as soon as the humidity is predicted
+to sink to setpoint_low before new fog could arrive.
+
+Each kind of control is a class with update(humidity, now, variance)
+returning the (relay, fan speed) to set, for a filtered humidity reading
+and its variance (see filters.py), hold(now) returning what to keep
+them at while a reading failed, and stop(now) for when the controller
+has switched everything off after too many failed readings.
+from_config() builds the one a chamber is configured for.
+
+Overshoot and CycleRate measure the two things these are meant to
+reduce: how far humidity goes above setpoint_high, and how often the
+relay switches on.
+'''
+import bisect
+import collections
+import math
+
+import numpy as np
+
+
+class PID(object):
+    """PID controller with output limits and anti-windup.
+
+    The derivative acts on the measurement rather than the error, so
+    changing the setpoint does not kick the output. The integral only
+    moves when that does not push a saturated output further past its
+    limit (conditional integration), so it does not wind up while the
+    fogger cannot keep up or the chamber is too humid with the fogger
+    off, and it recovers as soon as the error changes sign. kd=0 makes
+    it a PI controller.
+    """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, output_min=0.0, output_max=1.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_min = output_min
+        self.output_max = output_max
+        self.integral = 0.0
+        self.output = output_min
+        self._last = None
+
+    def hold(self):
+        """Forgets the last measurement, so the next update() after a gap
+        (sensor errors) neither integrates over it nor differentiates
+        across it."""
+        self._last = None
+
+    def reset(self):
+        """Zeroes the output and integral, as if just started."""
+        self.integral = 0.0
+        self.output = self.output_min
+        self._last = None
+
+    def update(self, setpoint, measurement, now):
+        """The output for measurement at time now (seconds, any clock)."""
+        error = setpoint - measurement
+        dt = 0.0
+        derivative = 0.0
+        if self._last is not None:
+            dt = now - self._last[0]
+            if dt > 0:
+                derivative = -(measurement - self._last[1]) / dt
+        self._last = (now, measurement)
+
+        integral = self.integral + self.ki * error * dt
+        integral = min(max(integral, self.output_min), self.output_max)
+        unclamped = self.kp * error + integral + self.kd * derivative
+        self.output = min(max(unclamped, self.output_min), self.output_max)
+        if self.output == unclamped or (unclamped > self.output_max) == (error < 0):
+            self.integral = integral
+        return self.output
+
+
+def split(output, fan_split):
+    """(fogger duty, fan speed) for a PID output, both 0 to 1."""
+    if output <= fan_split:
+        return output / fan_split, 0.0
+    return 1.0, (output - fan_split) / (1 - fan_split)
+
+
+class TimeProportioner(object):
+    """Runs a relay for a duty cycle over windows of period seconds.
+
+    The relay is on at the start of each window for duty * period
+    seconds, once: a duty raised after the relay went off waits for the
+    next window. On times shorter than min_on are skipped and off times
+    shorter than min_off are filled in, and the relay is never switched
+    again less than min_on seconds after switching on or min_off seconds
+    after switching off, however the duty changes.
+    """
+
+    def __init__(self, period, min_on=0.0, min_off=0.0):
+        self.period = period
+        self.min_on = min_on
+        self.min_off = min_off
+        self.state = False
+        self.changed = None
+        self._window = None
+        self._pulsed = False
+
+    def update(self, duty, now):
+        """Whether the relay should be on at time now (seconds)."""
+        if self._window is None:
+            self._window = now
+        elif now - self._window >= self.period:
+            self._window += (now - self._window) // self.period * self.period
+            self._pulsed = False
+        on_time = duty * self.period
+        if on_time < self.min_on:
+            on_time = 0.0
+        elif self.period - on_time < self.min_off:
+            on_time = self.period
+        state = now - self._window < on_time and not self._pulsed
+        if state != self.state and self.changed is not None:
+            if now - self.changed < (self.min_on if self.state else self.min_off):
+                state = self.state
+        if state != self.state:
+            self.state = state
+            self.changed = now
+            self._pulsed = not state
+        return self.state
+
+    def off(self, now):
+        """The relay was switched off at now by someone else."""
+        if self.state:
+            self.state = False
+            self.changed = now
+            self._pulsed = True
+
+
+class HardwarePWM(object):
+    """Fan speed through the Pi's PWM hardware, via wiringpi.
+
+    Set up like pwmfan.py: mark-space mode with a clock divisor of 6 and
+    a range of 128, 19.2 MHz / 6 / 128 = 25 kHz as PC fans expect. Only
+    GPIO 12, 13, 18 and 19 have hardware PWM, and 12/18 and 13/19 share
+    a channel, so fans on the same channel run at the same speed.
+    """
+    PINS = (12, 13, 18, 19)
+    PWM_OUTPUT = 2
+    PWM_MODE_MS = 0
+
+    def __init__(self, wiringpi, clock=6, range=128):
+        self.wiringpi = wiringpi
+        self.clock = clock
+        self.range = range
+        self._ready = False
+
+    def setup(self, pin):
+        if pin not in self.PINS:
+            raise ValueError('GPIO {} has no hardware PWM, use one of {}'.format(pin, self.PINS))
+        if not self._ready:
+            self.wiringpi.wiringPiSetupGpio()
+            self._ready = True
+        # Switching a pin to PWM resets the mode, clock and range to
+        # balanced mode defaults, so they are set after it.
+        self.wiringpi.pinMode(pin, self.PWM_OUTPUT)
+        self.wiringpi.pwmSetMode(self.PWM_MODE_MS)
+        self.wiringpi.pwmSetClock(self.clock)
+        self.wiringpi.pwmSetRange(self.range)
+        self.wiringpi.pwmWrite(pin, 0)
+
+    def write(self, pin, duty):
+        """Sets the fan on pin to duty, from 0 (off) to 1 (full speed)."""
+        self.wiringpi.pwmWrite(pin, int(round(min(max(duty, 0.0), 1.0) * self.range)))
+
+
+class Hysteresis(object):
+    """Fogger and fan on below low, off above high, unchanged between."""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.on = False
+        self.action = None
+
+    def hold(self, now):
+        self.action = "hold, fan {}".format("on" if self.on else "off")
+        return self.on, 1.0 if self.on else 0.0
+
+    def stop(self, now):
+        self.on = False
+
+    def update(self, humidity, now, variance=0.0):
+        if humidity > self.high:
+            self.on = False
+            self.action = "fan off"
+        elif humidity < self.low:
+            self.on = True
+            self.action = "fan on"
+        else:
+            self.action = "else..."
+        return self.on, 1.0 if self.on else 0.0
+
+
+class PIDControl(object):
+    """A PID output split between a time-proportioned fogger and the fan
+    speed, see split().
+
+    While readings fail the last output keeps the fogger cycling, with
+    the PID neither integrating nor differentiating across the gap;
+    stop() starts it over from zero.
+    """
+
+    def __init__(self, setpoint, pid, fogger, fan_split):
+        self.setpoint = setpoint
+        self.pid = pid
+        self.fogger = fogger
+        self.fan_split = fan_split
+        self.action = None
+
+    def hold(self, now):
+        """Keeps the last output going."""
+        self.pid.hold()
+        return self._actuate(self.pid.output, now)
+
+    def stop(self, now):
+        self.pid.reset()
+        self.fogger.off(now)
+
+    def update(self, humidity, now, variance=0.0):
+        return self._actuate(self.pid.update(self.setpoint, humidity, now), now)
+
+    def _actuate(self, output, now):
+        duty, speed = split(output, self.fan_split)
+        on = self.fogger.update(duty, now)
+        speed = speed if on else 0.0
+        self.action = "pid output {:.2f}, fogger {}, fan {:.0%}".format(
+            output, "on" if on else "off", speed)
+        return on, speed
+
+
+# Fitted model of the chamber:
+#     dh/dt = (ambient - h) / tau + gain * u(t - dead_time)
+# with u 1 while the fogger (and fan) run and 0 otherwise, gain in %RH/s,
+# tau and dead_time in seconds. rmse is the fit's error in %RH/s.
+FOPDT = collections.namedtuple('FOPDT', 'gain tau dead_time ambient rmse')
+
+
+def fit_fopdt(t, h, u, max_dead_time=120.0, step=2.0, max_gap=30.0):
+    """Least squares fit of an FOPDT model to samples at times t (seconds)
+    of humidity h while the relay was u (1 or 0, from each sample until
+    the next).
+
+    Every dead time from 0 to max_dead_time in steps of step is fitted
+    at once, as one batch of 3 x 3 normal equations, and the one with the
+    smallest error is returned. Sample intervals longer than max_gap
+    (the controller was down) are left out. Returns None if the samples
+    do not determine a stable model: the relay never switched in them,
+    or humidity does not settle towards an ambient value.
+    """
+    t = np.asarray(t, dtype=float)
+    h = np.asarray(h, dtype=float)
+    u = np.asarray(u, dtype=float)
+    if len(t) < 3:
+        return None
+    dt = np.diff(t)
+    delays = np.arange(0.0, max_dead_time + step / 2, step)
+    # Intervals that have a full dead time of history before them.
+    k = np.nonzero((t[:-1] - t[0] >= max_dead_time) & (dt > 0) & (dt <= max_gap))[0]
+    if len(k) < 10:
+        return None
+    rate = (h[k + 1] - h[k]) / dt[k]
+
+    # The relay state delay seconds before each sample, per delay.
+    lagged = u[np.searchsorted(t, t[k] - delays[:, None], side='right') - 1]
+    X = np.stack([np.ones_like(lagged), np.broadcast_to(h[k], lagged.shape), lagged], axis=-1)
+    solvable = (lagged.min(axis=1) != lagged.max(axis=1)) & (h[k].min() != h[k].max())
+    if not solvable.any():
+        return None
+    X = X[solvable]
+    coef = np.einsum('dij,dj->di', np.linalg.pinv(np.einsum('dni,dnj->dij', X, X)),
+                     np.einsum('dni,n->di', X, rate))
+    sse = ((rate - np.einsum('dni,di->dn', X, coef)) ** 2).sum(axis=1)
+    best = sse.argmin()
+    c0, c1, c2 = coef[best]
+    if c1 >= 0 or c2 <= 0:
+        return None
+    return FOPDT(gain=c2, tau=-1 / c1, dead_time=delays[solvable][best], ambient=-c0 / c1,
+                 rmse=math.sqrt(sse[best] / len(k)))
+
+
+class Predictive(object):
+    """On/off control that switches early, from an FOPDT model fitted to
+    the last window seconds of samples every refit seconds.
+
+    Fog switched on now reaches the sensor dead_time seconds later, so
+    the humidity then follows from the relay states already chosen over
+    the last dead_time seconds. The relay goes off once that predicted
+    humidity comes within margin of high, and on once it sinks to within
+    margin of low; the margin, widened to the readings' standard
+    deviation when that is larger, leaves room for sensor noise and
+    model error. Until there is a model (the relay has to have switched within
+    the window) this is plain hysteresis.
+    """
+
+    def __init__(self, low, high, window=1800.0, max_dead_time=120.0, refit=60.0,
+                 margin=0.5):
+        self.low = low
+        self.high = high
+        self.margin = margin
+        self.window = window
+        self.max_dead_time = max_dead_time
+        self.refit = refit
+        self.model = None
+        self.on = False
+        self.action = None
+        self._fitted = None
+        self._times = []
+        self._humidity = []
+        self._relay = []
+
+    def hold(self, now):
+        """Keeps the relay as it is. Nothing is recorded for the model, the
+        fit leaves the gap out."""
+        self.action = "hold, fan {}".format("on" if self.on else "off")
+        return self.on, 1.0 if self.on else 0.0
+
+    def stop(self, now):
+        self.on = False
+
+    def fit(self, now):
+        model = fit_fopdt(self._times, self._humidity, self._relay, self.max_dead_time)
+        if model is not None:
+            self.model = model
+        self._fitted = now
+
+    def predict(self, humidity, now):
+        """Humidity dead_time seconds from now, from the model and the
+        relay states of the last dead_time seconds."""
+        model = self.model
+        start = now - model.dead_time
+        i = max(bisect.bisect_right(self._times, start) - 1, 0)
+        for j in range(i, len(self._times)):
+            begin = max(self._times[j], start)
+            end = self._times[j + 1] if j + 1 < len(self._times) else now
+            steady = model.ambient + model.gain * model.tau * self._relay[j]
+            humidity = steady + (humidity - steady) * math.exp(-(end - begin) / model.tau)
+        return humidity
+
+    def update(self, humidity, now, variance=0.0):
+        if self._fitted is None or now - self._fitted >= self.refit:
+            self.fit(now)
+        predicted = None
+        if humidity > self.high:
+            self.on = False
+        elif humidity < self.low:
+            self.on = True
+        elif self.model is not None:
+            predicted = self.predict(humidity, now)
+            margin = max(self.margin, math.sqrt(variance))
+            if self.on and predicted >= self.high - margin:
+                self.on = False
+            elif not self.on and predicted <= self.low + margin:
+                self.on = True
+        if predicted is None:
+            self.action = "fan on" if self.on else "fan off"
+        else:
+            self.action = "fan {}, predicted {:.1f}% in {:.0f} s".format(
+                "on" if self.on else "off", predicted, self.model.dead_time)
+
+        self._times.append(now)
+        self._humidity.append(humidity)
+        self._relay.append(1 if self.on else 0)
+        old = bisect.bisect_left(self._times, now - self.window)
+        if old:
+            del self._times[:old], self._humidity[:old], self._relay[:old]
+        return self.on, 1.0 if self.on else 0.0
+
+
+def from_config(config):
+    """The control for a chambers.ChamberConfig."""
+    if config.control == 'pid':
+        return PIDControl(config.setpoint, PID(config.kp, config.ki, config.kd),
+                          TimeProportioner(config.fog_period, config.min_on, config.min_off),
+                          config.fan_split)
+    if config.control == 'predictive':
+        return Predictive(config.setpoint_low, config.setpoint_high, config.model_window,
+                          config.max_dead_time)
+    return Hysteresis(config.setpoint_low, config.setpoint_high)
+
+
+class Overshoot(object):
+    """Excursions of the humidity above a limit.
+
+    update() returns how far the humidity peaked above limit once it has
+    come back down to margin below it, and None otherwise. The margin
+    keeps sensor noise around the limit from counting as many
+    excursions.
+    """
+
+    def __init__(self, limit, margin=0.5):
+        self.limit = limit
+        self.margin = margin
+        self.peak = None
+
+    def update(self, humidity):
+        if humidity > self.limit:
+            self.peak = humidity if self.peak is None else max(self.peak, humidity)
+            return None
+        if humidity > self.limit - self.margin:
+            return None
+        peak, self.peak = self.peak, None
+        return None if peak is None else peak - self.limit
+
+
+class CycleRate(object):
+    """Counts events (relay switch-ons) over a sliding window of seconds."""
+
+    def __init__(self, window=3600.0):
+        self.window = window
+        self._times = collections.deque()
+
+    def add(self, now):
+        self._times.append(now)
+
+    def count(self, now):
+        while self._times and self._times[0] <= now - self.window:
+            self._times.popleft()
+        return len(self._times)
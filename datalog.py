@@ -0,0 +1,555 @@
+'''
+Humidity Controller data log
+
+SQLite storage for the sensor samples. The schema is versioned with
+PRAGMA user_version and older databases are migrated in place when they
+are opened, so an existing datalog.db keeps its history.
+
+Samples live in the temps table keyed by chamber and integer epoch
+milliseconds:
+
+    temps (ts INTEGER, temp REAL, humidity REAL, setpoint REAL,
+           chamber INTEGER, humidity_var REAL)
+
+with an index on (chamber, ts) so tail and range reads stay cheap however
+long the log gets. Chamber ids map to the configured chamber names in the
+chambers table; databases from before chambers existed have all their
+history in chamber 0, 'main'. humidity_var is the variance the sensor
+filter (filters.py) estimated for the humidity, NULL where it was not
+recorded; it is not kept in rollups or the archive.
+
+Every insert also updates the rollups table, which keeps count/min/max/
+sum of each column per 1 minute, 1 hour and 1 day bucket for long range
+views.
+
+Samples older than a retention age can be moved out of temps into the
+archive_chunks table by archive_rows(): one Gorilla compressed chunk (see
+gorilla.py) per chamber and hour, a fraction of the size. Each chunk is
+decoded again and compared with its rows before they are deleted. The
+read functions below return archived samples along with the hot ones, so
+callers do not need to know where a sample lives.
+
+Writes go through DataWriter, a background thread that batches samples
+into one WAL-mode transaction so the control loop never waits on SQLite.
+'''
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+import gorilla
+import metrics
+
+DB_PATH = '/home/pi/datalog.db'
+
+COMMIT_SECONDS = metrics.Histogram(
+    'datalog_commit_seconds', 'Time to insert and commit one batch of samples.')
+COMMITTED_SAMPLES = metrics.Counter(
+    'datalog_committed_samples_total', 'Samples committed to the data log.')
+COMMIT_RETRIES = metrics.Counter(
+    'datalog_commit_retries_total', 'Batch commits that failed and were retried.')
+DROPPED_SAMPLES = metrics.Counter(
+    'datalog_dropped_samples_total', 'Samples dropped because the writer fell behind.')
+ARCHIVE_SECONDS = metrics.Histogram(
+    'datalog_archive_seconds', 'Time to move old samples to the archive.')
+ARCHIVED_SAMPLES = metrics.Counter(
+    'datalog_archived_samples_total', 'Samples moved from the hot table to the archive.')
+
+
+def now_ms():
+    """Current wall clock time in epoch milliseconds."""
+    return int(time.time() * 1000)
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+
+
+def _migrate_v1(conn):
+    """Epoch millisecond timestamps, REAL columns and a timestamp index.
+
+    The original table stored datetime('now') text (UTC, one second
+    resolution) and NUMERIC values with no index at all.
+    """
+    legacy = _table_columns(conn, 'temps')
+    if legacy:
+        conn.execute("ALTER TABLE temps RENAME TO temps_v0")
+    conn.execute("CREATE TABLE temps (ts INTEGER NOT NULL, temp REAL,"
+                 " humidity REAL, setpoint REAL)")
+    if legacy:
+        conn.execute("INSERT INTO temps (ts, temp, humidity, setpoint)"
+                     " SELECT CAST(strftime('%s', timestamp) AS INTEGER) * 1000,"
+                     " temp, humidity, setpoint FROM temps_v0"
+                     " WHERE timestamp IS NOT NULL ORDER BY timestamp")
+        conn.execute("DROP TABLE temps_v0")
+    conn.execute("CREATE INDEX temps_ts ON temps (ts)")
+
+
+# Rollup bucket lengths in milliseconds.
+ROLLUP_1M = 60 * 1000
+ROLLUP_1H = 60 * ROLLUP_1M
+ROLLUP_1D = 24 * ROLLUP_1H
+ROLLUP_PERIODS = (ROLLUP_1M, ROLLUP_1H, ROLLUP_1D)
+
+ROLLUP_COLUMNS = ('temp', 'humidity', 'setpoint')
+
+
+def _rollup_stats():
+    return ', '.join('{0}_min, {0}_max, {0}_sum'.format(c)
+                     for c in ROLLUP_COLUMNS)
+
+
+def _migrate_v2(conn):
+    """Rollup tiers, backfilled from the existing samples."""
+    columns = ', '.join('{0}_min REAL, {0}_max REAL, {0}_sum REAL'.format(c)
+                        for c in ROLLUP_COLUMNS)
+    conn.execute("CREATE TABLE rollups (period INTEGER NOT NULL,"
+                 " bucket INTEGER NOT NULL, n INTEGER NOT NULL, " + columns +
+                 ", PRIMARY KEY (period, bucket)) WITHOUT ROWID")
+    aggregates = ', '.join('min({0}), max({0}), sum({0})'.format(c)
+                           for c in ROLLUP_COLUMNS)
+    for period in ROLLUP_PERIODS:
+        conn.execute("INSERT INTO rollups (period, bucket, n, " + _rollup_stats() +
+                     ") SELECT ?, ts - ts % ?, count(*), " + aggregates +
+                     " FROM temps GROUP BY ts - ts % ?", (period, period, period))
+
+
+def _migrate_v3(conn):
+    """Chamber dimension for samples and rollups."""
+    conn.execute("CREATE TABLE chambers (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("INSERT INTO chambers (id, name) VALUES (0, 'main')")
+
+    conn.execute("ALTER TABLE temps ADD COLUMN chamber INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP INDEX temps_ts")
+    conn.execute("CREATE INDEX temps_chamber_ts ON temps (chamber, ts)")
+
+    columns = ', '.join('{0}_min REAL, {0}_max REAL, {0}_sum REAL'.format(c)
+                        for c in ROLLUP_COLUMNS)
+    conn.execute("ALTER TABLE rollups RENAME TO rollups_v2")
+    conn.execute("CREATE TABLE rollups (chamber INTEGER NOT NULL, period INTEGER NOT NULL,"
+                 " bucket INTEGER NOT NULL, n INTEGER NOT NULL, " + columns +
+                 ", PRIMARY KEY (chamber, period, bucket)) WITHOUT ROWID")
+    conn.execute("INSERT INTO rollups SELECT 0, * FROM rollups_v2")
+    conn.execute("DROP TABLE rollups_v2")
+
+
+def _migrate_v4(conn):
+    """Compressed archive of old samples."""
+    conn.execute("CREATE TABLE archive_chunks (chamber INTEGER NOT NULL,"
+                 " first_ts INTEGER NOT NULL, last_ts INTEGER NOT NULL,"
+                 " n INTEGER NOT NULL, data BLOB NOT NULL)")
+    conn.execute("CREATE INDEX archive_chunks_chamber_ts ON archive_chunks (chamber, first_ts)")
+    # Lets archive_rows() give the pages it frees back to the filesystem.
+    # Takes effect with the VACUUM at the end of migrate().
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+
+def _migrate_v5(conn):
+    """Humidity variance from the sensor filter."""
+    conn.execute("ALTER TABLE temps ADD COLUMN humidity_var REAL")
+
+
+# MIGRATIONS[n] upgrades a database from user_version n to n + 1.
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Brings the database up to SCHEMA_VERSION, one transaction per step.
+
+    Returns True if anything was migrated.
+    """
+    version = schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database schema version {} is newer than this code "
+                           "supports ({}).".format(version, SCHEMA_VERSION))
+    if version == SCHEMA_VERSION:
+        return False
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        while version < SCHEMA_VERSION:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                MIGRATIONS[version](conn)
+                version += 1
+                conn.execute("PRAGMA user_version = {:d}".format(version))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            print("Migrated database to schema version {}.".format(version))
+        # Give the pages freed by copied tables back to the filesystem.
+        conn.execute("VACUUM")
+    finally:
+        conn.isolation_level = isolation_level
+    return True
+
+
+def connect(path=DB_PATH, **kwargs):
+    """Opens the data log, migrating it to the current schema if needed."""
+    conn = sqlite3.connect(path, **kwargs)
+    migrate(conn)
+    return conn
+
+
+def chamber_id(conn, name):
+    """The id of the named chamber, adding it if it is new."""
+    row = conn.execute("SELECT id FROM chambers WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        with conn:
+            cursor = conn.execute("INSERT INTO chambers (name) VALUES (?)", (name,))
+        return cursor.lastrowid
+    return row[0]
+
+
+def chamber_names(conn):
+    """{id: name} for every chamber in the log."""
+    return dict(conn.execute("SELECT id, name FROM chambers"))
+
+
+_UPSERT_ROLLUP = (
+    "INSERT INTO rollups (chamber, period, bucket, n, " + _rollup_stats() + ")"
+    " VALUES (?, ?, ?, ?, " + ', '.join(['?'] * 3 * len(ROLLUP_COLUMNS)) + ")"
+    " ON CONFLICT (chamber, period, bucket) DO UPDATE SET n = n + excluded.n, " +
+    ', '.join('{0}_min = min({0}_min, excluded.{0}_min), '
+              '{0}_max = max({0}_max, excluded.{0}_max), '
+              '{0}_sum = {0}_sum + excluded.{0}_sum'.format(c)
+              for c in ROLLUP_COLUMNS))
+
+
+def _rollup_batch(samples):
+    """Folds (ts, temp, humidity, setpoint, chamber) samples into rollup
+    rows."""
+    buckets = {}
+    for sample in samples:
+        ts = sample[0]
+        values = sample[1:4]
+        chamber = sample[4]
+        for period in ROLLUP_PERIODS:
+            key = (chamber, period, ts - ts % period)
+            stats = buckets.get(key)
+            if stats is None:
+                stats = buckets[key] = [0]
+                for v in values:
+                    stats += [v, v, 0.0]
+            stats[0] += 1
+            for i, v in enumerate(values):
+                j = 1 + 3 * i
+                if v < stats[j]:
+                    stats[j] = v
+                if v > stats[j + 1]:
+                    stats[j + 1] = v
+                stats[j + 2] += v
+    return [key + tuple(stats) for key, stats in buckets.items()]
+
+
+def insert_samples(conn, samples):
+    """Inserts (ts, temp, humidity, setpoint, chamber[, humidity_var])
+    samples and updates the rollups.
+
+    Does not commit; callers batch this into their own transaction.
+    """
+    conn.executemany("INSERT INTO temps (ts, temp, humidity, setpoint, chamber, humidity_var)"
+                     " VALUES (?, ?, ?, ?, ?, ?)",
+                     [s if len(s) == 6 else tuple(s) + (None,) for s in samples])
+    conn.executemany(_UPSERT_ROLLUP, _rollup_batch(samples))
+
+
+def add_data(conn, temp, hum, setpoint, ts=None, chamber=0):
+    if ts is None:
+        ts = now_ms()
+    insert_samples(conn, [(ts, temp, hum, setpoint, chamber)])
+
+
+def get_rows(conn, limit=1000, chamber=0):
+    """The newest (ts, temp, humidity, setpoint) rows of a chamber,
+    oldest first."""
+    rows = conn.execute("SELECT ts, temp, humidity, setpoint FROM temps"
+                        " WHERE chamber = ? ORDER BY ts DESC LIMIT ?",
+                        (chamber, limit)).fetchall()
+    if len(rows) < limit:
+        # Fewer hot rows than asked for: go back into the archive.
+        before = rows[-1][0] if rows else sys.maxsize
+        chunks = conn.execute("SELECT data FROM archive_chunks"
+                              " WHERE chamber = ? AND first_ts < ? ORDER BY first_ts DESC",
+                              (chamber, before))
+        for (data,) in chunks:
+            archived = [row for row in gorilla.decode(data) if row[0] < before]
+            rows.extend(reversed(archived[-(limit - len(rows)):]))
+            if len(rows) >= limit:
+                break
+    rows.reverse()
+    return rows
+
+
+def _archived_range(conn, start, end, chamber):
+    rows = []
+    chunks = conn.execute("SELECT data FROM archive_chunks WHERE chamber = ?"
+                          " AND first_ts < ? AND last_ts >= ? ORDER BY first_ts",
+                          (chamber, end, start))
+    for (data,) in chunks:
+        # Rows are in ts order within a chunk.
+        for row in gorilla.iter_decode(data):
+            if row[0] >= end:
+                break
+            if row[0] >= start:
+                rows.append(row)
+    return rows
+
+
+def get_range(conn, start, end=None, chamber=0):
+    """Rows of a chamber with start <= ts < end, oldest first, archived
+    ones included."""
+    if end is None:
+        end = sys.maxsize
+    rows = _archived_range(conn, start, end, chamber)
+    hot = conn.execute("SELECT ts, temp, humidity, setpoint FROM temps"
+                       " WHERE chamber = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                       (chamber, start, end)).fetchall()
+    if not rows:
+        return hot
+    rows.extend(hot)
+    # Usually already in order; samples that arrived after their hour was
+    # archived are the exception.
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+# Archive chunks hold one hour of one chamber, so reading a short range
+# decodes little more than it returns.
+ARCHIVE_PARTITION = ROLLUP_1H
+
+
+class ArchiveError(ValueError):
+    """An archive chunk did not decode back to the rows it was made of."""
+
+
+def archive_rows(conn, before, partition=ARCHIVE_PARTITION):
+    """Moves the samples older than before (epoch ms, rounded down to a
+    partition boundary) from temps into compressed archive chunks, one
+    chunk per chamber and partition. Rollups are kept.
+
+    Every chunk is decoded and checked against its rows before they are
+    deleted; ArchiveError is raised if one does not match, and the
+    caller's transaction should be rolled back. Does not commit. Returns
+    the number of samples archived.
+    """
+    before -= before % partition
+    moved = 0
+    for chamber in sorted(chamber_names(conn)):
+        while True:
+            first = conn.execute("SELECT min(ts) FROM temps WHERE chamber = ? AND ts < ?",
+                                 (chamber, before)).fetchone()[0]
+            if first is None:
+                break
+            end = min(first - first % partition + partition, before)
+            rows = conn.execute(
+                "SELECT ts, temp, humidity, setpoint FROM temps"
+                " WHERE chamber = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (chamber, first, end)).fetchall()
+            data = gorilla.encode(rows)
+            if gorilla.decode(data) != [tuple(row) for row in rows]:
+                raise ArchiveError('Chunk of chamber {} from {} does not decode to its {} rows'
+                                   .format(chamber, first, len(rows)))
+            conn.execute("INSERT INTO archive_chunks (chamber, first_ts, last_ts, n, data)"
+                         " VALUES (?, ?, ?, ?, ?)",
+                         (chamber, rows[0][0], rows[-1][0], len(rows), data))
+            conn.execute("DELETE FROM temps WHERE chamber = ? AND ts >= ? AND ts < ?",
+                         (chamber, first, end))
+            moved += len(rows)
+    return moved
+
+
+class DataWriter(threading.Thread):
+    """Group-commit writer for the data log.
+
+    add() never blocks: samples go into a bounded queue and are written
+    with executemany in one transaction every batch_size samples or
+    flush_interval seconds, whichever comes first. If the queue fills up
+    (the SD card stalls for a long time) the oldest pending samples are
+    dropped and counted in self.dropped.
+
+    synchronous is the SQLite PRAGMA synchronous level used for the
+    writer's connection. In WAL mode NORMAL only risks the last batches
+    on power loss, never corruption; FULL fsyncs every commit.
+
+    With retention set (in seconds), samples older than that are moved to
+    the archive every retention_interval seconds, see archive_rows().
+    """
+
+    _STOP = object()
+
+    def __init__(self, path=DB_PATH, batch_size=30, flush_interval=10.0,
+                 max_pending=10000, synchronous='NORMAL', busy_timeout=5.0,
+                 retention=None, retention_interval=3600.0):
+        super(DataWriter, self).__init__(name='DataWriter', daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.retention_interval = retention_interval
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.commits = 0
+        self.retries = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+
+    def add(self, temp, hum, setpoint, ts=None, chamber=0, relay=None, humidity_var=None):
+        # relay is accepted for samplelog.SampleLogStore compatibility;
+        # the temps table has no column for it.
+        if ts is None:
+            ts = now_ms()
+        self._put((ts, temp, hum, setpoint, chamber, humidity_var))
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                    DROPPED_SAMPLES.inc()
+                except queue.Empty:
+                    pass
+
+    def close(self, timeout=None):
+        """Flushes whatever is pending and stops the thread."""
+        if not self.is_alive():
+            return
+        # Wait for room rather than push out a pending sample.
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+    def _open(self):
+        conn = connect(self.path, timeout=self.busy_timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous={}".format(self.synchronous))
+        return conn
+
+    def _commit(self, conn, batch):
+        with COMMIT_SECONDS.time():
+            with conn:
+                insert_samples(conn, batch)
+        self.commits += 1
+        COMMITTED_SAMPLES.inc(len(batch))
+
+    def _archive(self, conn):
+        try:
+            with ARCHIVE_SECONDS.time():
+                with conn:
+                    moved = archive_rows(conn, now_ms() - int(self.retention * 1000))
+                if moved:
+                    # executescript() steps the pragma until every free
+                    # page is released, execute() would free just one.
+                    conn.executescript("PRAGMA incremental_vacuum")
+        except (sqlite3.OperationalError, ArchiveError) as e:
+            print("Data log archiving deferred: {}".format(e))
+            return
+        ARCHIVED_SAMPLES.inc(moved)
+        if moved:
+            print("Archived {} samples.".format(moved))
+
+    def run(self):
+        conn = self._open()
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        next_archive = time.monotonic()
+        stopping = False
+        deferred = False
+        while True:
+            timeout = deadline - time.monotonic()
+            if not stopping and timeout > 0 and (deferred or len(batch) < self.batch_size):
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                if item is self._STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+                if len(batch) > self.max_pending:
+                    # A deferred batch is bounded like the queue.
+                    del batch[0]
+                    self.dropped += 1
+                    DROPPED_SAMPLES.inc()
+                continue
+
+            if batch:
+                try:
+                    self._commit(conn, batch)
+                    batch = []
+                    deferred = False
+                except sqlite3.OperationalError as e:
+                    # Locked or busy past the busy timeout, or the disk
+                    # failing. Keep the batch, and keep queueing into it,
+                    # until the next interval.
+                    print("Data log write deferred: {}".format(e))
+                    self.retries += 1
+                    COMMIT_RETRIES.inc()
+                    deferred = True
+                    if stopping:
+                        time.sleep(0.1)
+                        continue
+            if stopping:
+                break
+            if self.retention is not None and time.monotonic() >= next_archive:
+                self._archive(conn)
+                next_archive = time.monotonic() + self.retention_interval
+            deadline = time.monotonic() + self.flush_interval
+        conn.close()
+
+
+def get_rollups(conn, period, start, end=None, chamber=0):
+    """Rollup buckets of one tier and chamber with start <= bucket < end,
+    oldest first.
+
+    Each row is (bucket, n, temp_mean, temp_min, temp_max, humidity_mean,
+    humidity_min, humidity_max, setpoint_mean, setpoint_min, setpoint_max).
+    """
+    if end is None:
+        end = sys.maxsize
+    stats = ', '.join('{0}_sum / n, {0}_min, {0}_max'.format(c)
+                      for c in ROLLUP_COLUMNS)
+    return conn.execute("SELECT bucket, n, " + stats + " FROM rollups"
+                        " WHERE chamber = ? AND period = ? AND bucket >= ? AND bucket < ?"
+                        " ORDER BY bucket", (chamber, period, start, end)).fetchall()
+
+
+def count_samples(conn, start, end=None, chamber=0):
+    """About how many samples a chamber has with start <= ts < end,
+    from the 1 minute rollups (so rounded out to whole minutes)."""
+    if end is None:
+        end = sys.maxsize
+    return conn.execute("SELECT coalesce(sum(n), 0) FROM rollups"
+                        " WHERE chamber = ? AND period = ? AND bucket >= ? AND bucket < ?",
+                        (chamber, ROLLUP_1M, start - start % ROLLUP_1M, end)).fetchone()[0]
+
+
+if __name__ == "__main__":
+    # Migrate a database in place: python datalog.py [path]
+    path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    conn = sqlite3.connect(path)
+    if not migrate(conn):
+        print("{} is already at schema version {}.".format(path, SCHEMA_VERSION))
+    conn.close()
@@ -0,0 +1,78 @@
+'''
+Downsampling of sample series for plotting.
+
+lttb() picks the points of a series that keep its visual shape, with the
+Largest-Triangle-Three-Buckets algorithm (Steinarsson, 2013): the first
+and last points are kept and the rest are split into equal buckets, from
+each of which the point making the largest triangle with the point kept
+from the previous bucket and the mean of the next bucket is kept.
+
+Classic LTTB walks the buckets one at a time because each choice depends
+on the previous one. Here all buckets are handled at once with NumPy:
+the first pass anchors each triangle on the previous bucket's mean, and
+every further pass on the points the pass before kept. Once a pass keeps
+the same points as the one before, every choice follows from the
+previous one exactly as in sequential LTTB, so the result is the same.
+That usually takes under ten passes of a few array operations each;
+MAX_PASSES bounds the cost for pathological series.
+'''
+import numpy as np
+
+MAX_PASSES = 16
+
+
+def lttb(x, y, n):
+    """Indices of the n points of the series (x, y) LTTB keeps, in order.
+
+    x must be sorted. NaNs in y are never picked unless a bucket has
+    nothing else. A triangle corner that is NaN (the point kept before a
+    bucket, or the next bucket's mean, fell in a gap) takes the y of the
+    other corner, or of the bucket's own mean if both are NaN. Returns all
+    indices if there are no more than n points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        raise ValueError('LTTB needs at least 3 points, got {}'.format(n))
+
+    # Points 1 .. size - 2 go into n - 2 buckets of near equal length,
+    # padded to a rectangle by repeating each bucket's last point.
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    lengths = np.diff(edges)
+    idx = edges[:-1, None] + np.arange(lengths.max())
+    valid = idx < edges[1:, None]
+    idx = np.where(valid, idx, edges[1:, None] - 1)
+    bx = x[idx]
+    by = y[idx]
+
+    # Means over the points that have values; NaN for a bucket with none
+    # (a gap of failed reads), without nanmean's warning about it.
+    known = valid & ~np.isnan(by)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx = np.where(valid, bx, 0).sum(axis=1) / lengths
+        my = np.where(known, by, 0).sum(axis=1) / known.sum(axis=1)
+    # The third point of each triangle: the next bucket's mean, or the
+    # last point for the last bucket.
+    cx = np.append(mx[1:], x[-1])[:, None]
+    cy = np.append(my[1:], y[-1])[:, None]
+
+    ax = np.append(x[0], mx[:-1])[:, None]
+    ay = np.append(y[0], my[:-1])[:, None]
+    cy_gap = np.isnan(cy)
+    rows = np.arange(n - 2)
+    picked = None
+    for _ in range(MAX_PASSES):
+        ay = np.where(np.isnan(ay), np.where(cy_gap, my[:, None], cy), ay)
+        ty = np.where(cy_gap, ay, cy)
+        # Twice the triangle area; the factor does not change the argmax.
+        area = np.abs((ax - cx) * (by - ay) - (ax - bx) * (ty - ay))
+        area[np.isnan(area)] = -1
+        previous, picked = picked, idx[rows, area.argmax(axis=1)]
+        if previous is not None and np.array_equal(previous, picked):
+            break
+        ax = np.append(x[0], x[picked[:-1]])[:, None]
+        ay = np.append(y[0], y[picked[:-1]])[:, None]
+    return np.concatenate(([0], picked, [size - 1]))
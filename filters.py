@@ -0,0 +1,161 @@
+'''
+Streaming filter for sensor readings.
+
+Raw HTU21D readings pass three stages before the controller sees them:
+
+1. a range check drops readings no chamber can produce (a glitched
+   transfer that still passed the CRC, a failing sensor);
+2. a running median of the last window readings removes single spikes
+   without smearing real steps the way averaging would;
+3. an exponential moving average smooths what noise is left, with an
+   exponentially weighted variance alongside it as a measure of how
+   noisy the readings are.
+
+Every stage keeps a fixed amount of state and does a fixed amount of
+work per reading (the median window is small and fixed), however long
+the filter runs.
+
+IntervalMean condenses fast sampled, filtered readings into one mean per
+interval for logging.
+'''
+import bisect
+import collections
+import math
+
+# Plausible readings: the HTU21D's operating range for temperature, and
+# a little headroom above 100 %RH, which condensation on the sensor can
+# produce in a saturated chamber.
+TEMPERATURE_RANGE = (-40.0, 125.0)
+HUMIDITY_RANGE = (0.0, 102.0)
+
+# A filtered reading; the variances are in degrees squared and %RH squared.
+Filtered = collections.namedtuple(
+    'Filtered', 'temperature humidity dewpoint temperature_variance humidity_variance')
+
+
+class OutOfRange(ValueError):
+    """Every reading taken was outside the plausible range."""
+
+
+class RunningMedian(object):
+    """Median of the last size values."""
+
+    def __init__(self, size):
+        self.size = size
+        self._window = collections.deque()
+        self._sorted = []
+
+    def update(self, value):
+        if len(self._window) == self.size:
+            del self._sorted[bisect.bisect_left(self._sorted, self._window.popleft())]
+        self._window.append(value)
+        bisect.insort(self._sorted, value)
+        n = len(self._sorted)
+        if n % 2:
+            return self._sorted[n // 2]
+        return (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2.0
+
+
+class EMA(object):
+    """Exponential moving average and variance. alpha is the weight of
+    each new value, from 0 to 1; 1 passes values straight through."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.mean = None
+        self.variance = 0.0
+
+    def update(self, value):
+        if self.mean is None:
+            self.mean = value
+            return value
+        diff = value - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+        return self.mean
+
+
+class SensorFilter(object):
+    """Range check, running median and EMA for the temperature and
+    humidity readings of one sensor."""
+
+    def __init__(self, window=3, alpha=0.5, temperature_range=TEMPERATURE_RANGE,
+                 humidity_range=HUMIDITY_RANGE):
+        self.temperature_range = temperature_range
+        self.humidity_range = humidity_range
+        self._medians = (RunningMedian(window), RunningMedian(window))
+        self._emas = (EMA(alpha), EMA(alpha))
+        self.accepted = 0
+        self.rejected = 0
+
+    def update(self, temperature, humidity):
+        """Feeds one reading. Returns False if it was out of range and
+        dropped."""
+        low, high = self.temperature_range
+        if not low <= temperature <= high:
+            self.rejected += 1
+            return False
+        low, high = self.humidity_range
+        if not low <= humidity <= high:
+            self.rejected += 1
+            return False
+        for value, median, ema in zip((temperature, humidity), self._medians, self._emas):
+            ema.update(median.update(value))
+        self.accepted += 1
+        return True
+
+    def value(self):
+        """(temperature, humidity, temperature variance, humidity
+        variance), or None before the first accepted reading."""
+        temperature, humidity = self._emas
+        if temperature.mean is None:
+            return None
+        return temperature.mean, humidity.mean, temperature.variance, humidity.variance
+
+
+class IntervalMean(object):
+    """Means of Filtered readings over intervals of interval seconds on
+    the monotonic clock.
+
+    add() returns the finished interval's summary when a reading from a
+    later interval arrives: the mean epoch ms timestamp of its readings,
+    their mean as a Filtered, the relay state after its last reading and
+    the number of readings.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._index = None
+        self._count = 0
+        self._ts = 0
+        self._sums = [0.0] * len(Filtered._fields)
+        self._relay = None
+
+    def add(self, now, ts, values, relay):
+        """Adds values (a Filtered) read at now (time.monotonic()) and ts
+        (epoch ms), and the relay state that followed. Returns (ts, means,
+        relay, count) for the interval before, or None."""
+        index = math.floor(now / self.interval)
+        summary = None
+        if index != self._index:
+            summary = self.flush()
+            self._index = index
+        self._count += 1
+        self._ts += ts
+        self._sums = [total + value for total, value in zip(self._sums, values)]
+        self._relay = relay
+        return summary
+
+    def flush(self):
+        """The summary of the readings added so far, if any, which are then
+        cleared."""
+        if not self._count:
+            return None
+        count = self._count
+        summary = (self._ts // count, Filtered(*[total / count for total in self._sums]),
+                   self._relay, count)
+        self._count = 0
+        self._ts = 0
+        self._sums = [0.0] * len(Filtered._fields)
+        return summary
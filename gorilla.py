@@ -0,0 +1,180 @@
+'''
+Gorilla style compression for data log samples.
+
+encode() packs (ts, temp, humidity, setpoint) rows into a compact byte
+string the way Facebook's Gorilla time series database does:
+
+* timestamps (integer milliseconds) as the delta of their delta to the
+  previous one, in 1 bit when samples are evenly spaced and 9 to 16 bits
+  for the usual jitter;
+* values as the XOR of their IEEE 754 bits with the previous value of
+  the same column, in 1 bit when unchanged and otherwise only the bits
+  between the leading and trailing zeros of the XOR.
+
+The bit stream is then deflated with zlib. Compression is lossless and
+NULL values survive the round trip (they are stored as NaN, which SQLite
+cannot hold anyway).
+'''
+import math
+import struct
+import zlib
+
+# Delta of delta encodings: (prefix, prefix length, value bits), tried in
+# order. Values are two's complement.
+_DOD_ENCODINGS = (
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+    (0b1111, 4, 64),
+)
+
+_DOUBLE = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+_NAN_BITS = _UINT64.unpack(_DOUBLE.pack(float('nan')))[0]
+
+
+class _BitWriter(object):
+    def __init__(self):
+        self._parts = []
+
+    def write(self, value, bits):
+        self._parts.append(format(value & ((1 << bits) - 1), '0{}b'.format(bits)))
+
+    def getvalue(self):
+        bits = ''.join(self._parts)
+        bits += '0' * (-len(bits) % 8)
+        return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+
+class _BitReader(object):
+    def __init__(self, data):
+        self._bits = format(int.from_bytes(data, 'big'), '0{}b'.format(8 * len(data)))
+        self._pos = 0
+
+    def read(self, bits):
+        pos = self._pos
+        self._pos = pos + bits
+        return int(self._bits[pos:pos + bits], 2)
+
+    def read_signed(self, bits):
+        value = self.read(bits)
+        return value - (1 << bits) if value >> (bits - 1) else value
+
+    def bit(self):
+        pos = self._pos
+        self._pos = pos + 1
+        return self._bits[pos] == '1'
+
+
+def _float_bits(value):
+    if value is None:
+        return _NAN_BITS
+    return _UINT64.unpack(_DOUBLE.pack(value))[0]
+
+
+def _bits_float(bits):
+    value = _DOUBLE.unpack(_UINT64.pack(bits))[0]
+    return None if math.isnan(value) else value
+
+
+def encode(rows, level=6):
+    """Compresses (ts, value, ...) rows, sorted by ts, into bytes.
+
+    Every row must have the same number of values.
+    """
+    out = _BitWriter()
+    out.write(len(rows), 32)
+    if not rows:
+        return zlib.compress(out.getvalue(), level)
+    columns = len(rows[0]) - 1
+    out.write(columns, 8)
+
+    prev_ts = rows[0][0]
+    prev_delta = 0
+    out.write(prev_ts, 64)
+    # Per column: previous bits, leading and trailing zeros of the last
+    # XOR window written.
+    prev = [0] * columns
+    window = [None] * columns
+    for row in rows:
+        ts = row[0]
+        delta = ts - prev_ts
+        dod = delta - prev_delta
+        prev_ts, prev_delta = ts, delta
+        if dod == 0:
+            out.write(0, 1)
+        else:
+            for prefix, prefix_bits, bits in _DOD_ENCODINGS:
+                if -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+                    out.write(prefix, prefix_bits)
+                    out.write(dod, bits)
+                    break
+
+        for i in range(columns):
+            bits = _float_bits(row[i + 1])
+            xor = bits ^ prev[i]
+            prev[i] = bits
+            if xor == 0:
+                out.write(0, 1)
+                continue
+            leading = min(64 - xor.bit_length(), 31)
+            trailing = (xor & -xor).bit_length() - 1
+            last = window[i]
+            if last is not None and leading >= last[0] and trailing >= last[1]:
+                out.write(0b10, 2)
+                out.write(xor >> last[1], 64 - last[0] - last[1])
+            else:
+                length = 64 - leading - trailing
+                out.write(0b11, 2)
+                out.write(leading, 5)
+                out.write(length - 1, 6)
+                out.write(xor >> trailing, length)
+                window[i] = (leading, trailing)
+    return zlib.compress(out.getvalue(), level)
+
+
+def decode(data):
+    """The rows encode() compressed, as tuples."""
+    return list(iter_decode(data))
+
+
+def iter_decode(data):
+    """The rows encode() compressed, as tuples, decoded as they are
+    iterated, so a reader can stop early."""
+    bits = _BitReader(zlib.decompress(data))
+    count = bits.read(32)
+    if not count:
+        return
+    columns = bits.read(8)
+
+    ts = bits.read_signed(64)
+    delta = 0
+    prev = [0] * columns
+    window = [(0, 0)] * columns
+    for _ in range(count):
+        if bits.bit():
+            if not bits.bit():
+                width = 7
+            elif not bits.bit():
+                width = 9
+            elif not bits.bit():
+                width = 12
+            else:
+                width = 64
+            delta += bits.read_signed(width)
+        ts += delta
+
+        row = [ts]
+        for i in range(columns):
+            if bits.bit():
+                if bits.bit():
+                    leading = bits.read(5)
+                    length = bits.read(6) + 1
+                    trailing = 64 - leading - length
+                    window[i] = (leading, trailing)
+                else:
+                    leading, trailing = window[i]
+                    length = 64 - leading - trailing
+                prev[i] ^= bits.read(length) << trailing
+            row.append(_bits_float(prev[i]))
+        yield tuple(row)
@@ -23,12 +23,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import io
+import os
+import errno
 import time
 import math
 import fcntl
+import ctypes
 import logging
-import sys
 
 # RPI-2/3 IC2 default bus
 I2C_BUS                   = 1
@@ -36,6 +37,10 @@ I2C_BUS                   = 1
 # RPI I2C slave address
 I2C_SLAVE                 = 0x0703
 
+# Combined read/write transfer (one STOP only)
+I2C_RDWR                  = 0x0707
+I2C_M_RD                  = 0x0001
+
 # HTU21D-F default address
 HTU21D_I2CADDR            = 0x40
 
@@ -52,25 +57,65 @@ HTU21D_SOFTRESETCMD       = 0xFE  # Soft reset
 
 HTU21D_MAX_MEASURING_TIME = 0.1   # Sec
 
+# HTU21D-F measurement resolutions (user register bits 7 and 0)
+HTU21D_RES_RH12_T14       = 0x00  # Power on default
+HTU21D_RES_RH8_T12        = 0x01
+HTU21D_RES_RH10_T13       = 0x80
+HTU21D_RES_RH11_T11       = 0x81
+HTU21D_RES_MASK           = 0x81
+
+# Datasheet maximum conversion times (humidity, temperature) in seconds
+HTU21D_CONVERSION_TIMES   = {
+    HTU21D_RES_RH12_T14: (0.016, 0.050),
+    HTU21D_RES_RH8_T12:  (0.003, 0.013),
+    HTU21D_RES_RH10_T13: (0.005, 0.025),
+    HTU21D_RES_RH11_T11: (0.008, 0.007),
+}
+
+# No hold master polling: the sensor NACKs reads until the result is ready
+HTU21D_POLL_INTERVAL      = 0.002 # Sec
+HTU21D_NACK_ERRNOS        = (errno.EIO, errno.ENXIO, errno.EREMOTEIO)
+
 class HTU21DException(Exception):
     pass
 
+class _I2CMsg(ctypes.Structure):
+    _fields_ = [('addr',  ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len',   ctypes.c_uint16),
+                ('buf',   ctypes.POINTER(ctypes.c_uint8))]
+
+class _I2CRdwrIoctlData(ctypes.Structure):
+    _fields_ = [('msgs',  ctypes.POINTER(_I2CMsg)),
+                ('nmsgs', ctypes.c_uint32)]
+
 class HTU21DBusProtocol(object):
+    """I2C transport on /dev/i2c-N using a single read/write descriptor.
+
+    The descriptor stays open between open() and close(), and the bus can
+    be used as a context manager. open() on an already open bus is a no-op.
+    """
     def __init__(self, busnum = I2C_BUS, address = HTU21D_I2CADDR):
         self._busnum  = busnum
         self._address = address
 
         self._device_name = '/dev/i2c-{}'.format(self._busnum)
 
-        self._read_handler  = None
-        self._write_handler = None
+        self._fd = None
+
+    def is_open(self):
+        return self._fd is not None
 
     def open(self):
-        self._read_handler  = io.open(self._device_name, 'rb', buffering=0)
-        self._write_handler = io.open(self._device_name, 'wb', buffering=0)
+        if self._fd is not None:
+            return
 
-        fcntl.ioctl(self._read_handler,  I2C_SLAVE, self._address)
-        fcntl.ioctl(self._write_handler, I2C_SLAVE, self._address)
+        self._fd = os.open(self._device_name, os.O_RDWR)
+        try:
+            fcntl.ioctl(self._fd, I2C_SLAVE, self._address)
+        except IOError:
+            self.close()
+            raise
 
         time.sleep(HTU21D_MAX_MEASURING_TIME)
 
@@ -79,23 +124,50 @@ class HTU21DBusProtocol(object):
         return s if endianess == 'big' else s[::-1]
 
     def send_command(self, command):
-        self._write_handler.write(self.to_bytes(command))
+        os.write(self._fd, bytes(self.to_bytes(command)))
+
+    def write_bytes(self, data):
+        os.write(self._fd, bytes(bytearray(data)))
 
     def read_bytes(self, len):
-        msb, lsb, chsum = self._read_handler.read(len)
-        if sys.version_info < (3, 0):
-            # Python 2 needs to convert this from string to bytes.
-            msb = ord(msb)
-            lsb = ord(lsb)
-            chsum = ord(chsum)
-        return msb, lsb, chsum
+        return tuple(bytearray(os.read(self._fd, len)))
+
+    def write_read(self, command, length):
+        """Sends command and reads length bytes in one combined I2C_RDWR
+        transaction (repeated start, no STOP in between)."""
+        wbuf = (ctypes.c_uint8 * 1)(command)
+        rbuf = (ctypes.c_uint8 * length)()
+        msgs = (_I2CMsg * 2)(
+            _I2CMsg(self._address, 0, 1, wbuf),
+            _I2CMsg(self._address, I2C_M_RD, length, rbuf))
+        fcntl.ioctl(self._fd, I2C_RDWR, _I2CRdwrIoctlData(msgs, 2))
+        return tuple(bytearray(rbuf))
 
     def close(self):
-        self._read_handler.close()
-        self._write_handler.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class HTU21D(object):
-    def __init__(self, busnum=I2C_BUS, address=HTU21D_I2CADDR, mode=HTU21D_NOHOLDMASTER):
+    """HTU21D-F sensor.
+
+    By default the bus is opened and closed around every command. With
+    persistent=True (or inside a with block) one descriptor stays open for
+    the life of the sensor. combined=True reads hold master measurements
+    with a single I2C_RDWR transaction instead of a fixed sleep.
+
+    bus replaces the /dev/i2c-N transport with any object that has the
+    HTU21DBusProtocol methods, e.g. simulated.SimulatedHTU21DBus.
+    """
+    def __init__(self, busnum=I2C_BUS, address=HTU21D_I2CADDR, mode=HTU21D_NOHOLDMASTER,
+                 persistent=False, combined=False, bus=None):
         self._logger = logging.getLogger(__name__)
 
         # Check that mode is valid.
@@ -106,8 +178,16 @@ class HTU21D(object):
         self._address = address
         self._mode    = mode
 
+        self._persistent = persistent
+        self._combined   = combined
+        self._resolution = HTU21D_RES_RH12_T14
+
         # Create I2C device.
-        self._htu_handler = HTU21DBusProtocol(self._busnum, self._address)
+        if bus is None:
+            bus = HTU21DBusProtocol(self._busnum, self._address)
+        self._htu_handler = bus
+        if self._persistent:
+            self._htu_handler.open()
 
     def crc_check(self, msb, lsb, crc):
         remainder = ((msb << 8) | lsb) << 8
@@ -124,51 +204,139 @@ class HTU21D(object):
         else:
             return False
 
-    def reset(self):
-        """Reboots the sensor switching the power off and on again."""
+    def open(self):
+        """Opens the I2C bus. Only needed for persistent sensors; others
+        open and close the bus around every command."""
         self._htu_handler.open()
 
-        self._htu_handler.send_command(HTU21D_SOFTRESETCMD & 0xFF)
-        time.sleep(HTU21D_MAX_MEASURING_TIME)
+    def close(self):
         self._htu_handler.close()
 
-        return
+    def __enter__(self):
+        self._was_persistent = self._persistent
+        self._persistent = True
+        self.open()
+        return self
 
-    def read_raw_temp(self):
-        """Reads the raw temperature from the sensor."""
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._persistent = self._was_persistent
+        self.close()
+
+    def _begin(self):
         self._htu_handler.open()
 
-        self._htu_handler.send_command((HTU21D_TRIGGERTEMPCMD | self._mode) & 0xFF)
-        time.sleep(HTU21D_MAX_MEASURING_TIME)
+    def _end(self):
+        if not self._persistent:
+            self._htu_handler.close()
 
-        msb, lsb, chsum = self._htu_handler.read_bytes(3)
+    def reset(self):
+        """Reboots the sensor switching the power off and on again."""
+        self._begin()
+        try:
+            self._htu_handler.send_command(HTU21D_SOFTRESETCMD & 0xFF)
+            time.sleep(HTU21D_MAX_MEASURING_TIME)
+        finally:
+            self._end()
 
-        self._htu_handler.close()
+        # A soft reset restores the default resolution.
+        self._resolution = HTU21D_RES_RH12_T14
+
+        return
+
+    def read_user_register(self):
+        """Reads the user register."""
+        self._begin()
+        try:
+            if self._combined:
+                reg, = self._htu_handler.write_read(HTU21D_READUSERCMD, 1)
+            else:
+                self._htu_handler.send_command(HTU21D_READUSERCMD)
+                reg, = self._htu_handler.read_bytes(1)
+        finally:
+            self._end()
+
+        self._resolution = reg & HTU21D_RES_MASK
+        return reg
+
+    def write_user_register(self, value):
+        """Writes the user register."""
+        self._begin()
+        try:
+            self._htu_handler.write_bytes([HTU21D_WRITEUSERREGCMD, value & 0xFF])
+        finally:
+            self._end()
+
+        self._resolution = value & HTU21D_RES_MASK
+
+    def set_resolution(self, resolution):
+        """Sets the measurement resolution to one of the HTU21D_RES_* values.
+
+        Lower resolutions convert faster, see HTU21D_CONVERSION_TIMES. The
+        reserved bits of the user register are preserved as the datasheet
+        requires.
+        """
+        if resolution not in HTU21D_CONVERSION_TIMES:
+            raise ValueError('Unexpected resolution value {0}.  Set resolution to one of the HTU21D_RES_* values.'.format(resolution))
+
+        reg = self.read_user_register()
+        self.write_user_register((reg & ~HTU21D_RES_MASK) | resolution)
+
+    def get_resolution(self):
+        """The resolution last read from or written to the sensor."""
+        return self._resolution
+
+    def _poll_result(self, deadline):
+        """No hold master read: retry until the sensor stops NACKing or
+        time.monotonic() passes deadline."""
+        while True:
+            try:
+                return self._htu_handler.read_bytes(3)
+            except (IOError, OSError) as e:
+                if e.errno not in HTU21D_NACK_ERRNOS or time.monotonic() >= deadline:
+                    raise
+            time.sleep(HTU21D_POLL_INTERVAL)
+
+    def _measure(self, command, conversion_time):
+        """Triggers a measurement and returns the CRC checked raw value."""
+        command = (command | self._mode) & 0xFF
+        self._begin()
+        try:
+            if self._combined and self._mode == HTU21D_HOLDMASTER:
+                # The sensor stretches the clock until the result is ready.
+                msb, lsb, chsum = self._htu_handler.write_read(command, 3)
+            elif self._mode == HTU21D_NOHOLDMASTER:
+                self._htu_handler.send_command(command)
+                # Skip the polls that can't succeed yet, then poll up to
+                # twice the datasheet maximum before giving up.
+                start = time.monotonic()
+                time.sleep(conversion_time / 2)
+                msb, lsb, chsum = self._poll_result(start + 2 * conversion_time)
+            else:
+                self._htu_handler.send_command(command)
+                time.sleep(conversion_time)
+                msb, lsb, chsum = self._htu_handler.read_bytes(3)
+        finally:
+            self._end()
 
         if self.crc_check(msb, lsb, chsum) is False:
             raise HTU21DException("CRC Exception")
 
         raw = (msb << 8) + lsb
         raw &= 0xFFFC
+        return raw
+
+    def read_raw_temp(self):
+        """Reads the raw temperature from the sensor."""
+        raw = self._measure(HTU21D_TRIGGERTEMPCMD,
+                            HTU21D_CONVERSION_TIMES[self._resolution][1])
         self._logger.debug('Raw temp 0x{0:X} ({1})'.format(raw & 0xFFFF, raw))
 
         return raw
 
     def read_raw_humidity(self):
         """Reads the raw relative humidity from the sensor."""
-        self._htu_handler.open()
-
-        self._htu_handler.send_command((HTU21D_TRIGGERHUMIDITYCMD | self._mode) & 0xFF)
-        time.sleep(HTU21D_MAX_MEASURING_TIME)
-        msb, lsb, chsum = self._htu_handler.read_bytes(3)
-
-        self._htu_handler.close()
-
-        if self.crc_check(msb, lsb, chsum) is False:
-            raise HTU21DException("CRC Exception")
-
-        raw = (msb << 8) + lsb
-        raw &= 0xFFFC
+        raw = self._measure(HTU21D_TRIGGERHUMIDITYCMD,
+                            HTU21D_CONVERSION_TIMES[self._resolution][0])
         self._logger.debug('Raw relative humidity 0x{0:04X} ({1})'.format(raw & 0xFFFF, raw))
 
         return raw
@@ -211,3 +379,18 @@ class HTU21D(object):
 
         self._logger.debug('Dew Point {0:.2f} C'.format(dp))
         return dp
+
+    def read_all(self):
+        """Reads temperature and humidity in one bus session and returns
+        (temperature, humidity, dewpoint)."""
+        self._begin()
+        persistent = self._persistent
+        self._persistent = True
+        try:
+            t = self.read_temperature()
+            h = self.read_humidity()
+        finally:
+            self._persistent = persistent
+            self._end()
+
+        return t, h, self.dewpoint(t, h)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015-2017 Massimo Gaggero, 2018 Holger Kupke
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import random
+import threading
+import time
+
+from .htu21d import (HTU21D_I2CADDR, HTU21D_HOLDMASTER, HTU21D_NOHOLDMASTER,
+                     HTU21D_TRIGGERTEMPCMD, HTU21D_TRIGGERHUMIDITYCMD,
+                     HTU21D_WRITEUSERREGCMD, HTU21D_READUSERCMD,
+                     HTU21D_SOFTRESETCMD, HTU21D_RES_MASK,
+                     HTU21D_RES_RH12_T14, HTU21D_RES_RH8_T12,
+                     HTU21D_RES_RH10_T13, HTU21D_RES_RH11_T11,
+                     HTU21D_CONVERSION_TIMES)
+
+# Measurement bits per resolution (humidity, temperature)
+HTU21D_RESOLUTION_BITS = {
+    HTU21D_RES_RH12_T14: (12, 14),
+    HTU21D_RES_RH8_T12:  (8, 12),
+    HTU21D_RES_RH10_T13: (10, 13),
+    HTU21D_RES_RH11_T11: (11, 11),
+}
+
+HTU21D_USERREG_DEFAULT = 0x02
+
+def crc8(data):
+    """HTU21D CRC: polynomial x^8 + x^5 + x^4 + 1, initial value 0."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for i in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x31) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+class ConstantEnvironment(object):
+    def __init__(self, temperature=25.0, humidity=50.0):
+        self.temperature = temperature
+        self.humidity = humidity
+
+    def read(self):
+        return self.temperature, self.humidity
+
+class SimulatedHTU21DBus(object):
+    """In-process stand-in for HTU21DBusProtocol.
+
+    Answers the HTU21D command set with CRC valid frames computed from
+    environment.read(), which returns (temperature, humidity). Pass it to
+    HTU21D(bus=...).
+
+    conversion_scale multiplies the datasheet maximum conversion time for
+    the current resolution; 0 makes results available immediately. Reads
+    in no hold master mode NACK (raise OSError) until the conversion is
+    done, reads in hold master mode block, like the real sensor.
+
+    Errors can be injected at random with io_error_rate and
+    crc_error_rate, or for the next reads with fail_next().
+    """
+    def __init__(self, environment=None, conversion_scale=1.0,
+                 io_error_rate=0.0, crc_error_rate=0.0, seed=None,
+                 address=HTU21D_I2CADDR):
+        self.environment = environment or ConstantEnvironment()
+        self.conversion_scale = conversion_scale
+        self.io_error_rate = io_error_rate
+        self.crc_error_rate = crc_error_rate
+        self._address = address
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._open = False
+        self._userreg = HTU21D_USERREG_DEFAULT
+        self._pending = None
+        self._hold = False
+        self._forced = []
+        self.commands = 0
+        self.reads = 0
+
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fail_next(self, count=1, error='io'):
+        """Makes the next count reads fail with an 'io' or 'crc' error."""
+        self._forced.extend([error] * count)
+
+    def _check_open(self):
+        if not self._open:
+            raise OSError(errno.EBADF, 'Simulated bus is not open')
+
+    def _raw(self, command):
+        resolution = self._userreg & HTU21D_RES_MASK
+        hum_bits, temp_bits = HTU21D_RESOLUTION_BITS[resolution]
+        temperature, humidity = self.environment.read()
+        if command == HTU21D_TRIGGERTEMPCMD:
+            value = (temperature + 46.85) / 175.72 * 65536
+            bits, status = temp_bits, 0x00
+        else:
+            value = (humidity + 6) / 125.0 * 65536
+            bits, status = hum_bits, 0x02
+        raw = max(0, min(0xFFFF, int(value)))
+        raw &= (0xFFFF << (16 - bits)) & 0xFFFC
+        return raw | status
+
+    def send_command(self, command):
+        self.write_bytes([command])
+
+    def write_bytes(self, data):
+        self._check_open()
+        data = bytearray(data)
+        command = data[0]
+        with self._lock:
+            self.commands += 1
+            base = command & ~HTU21D_NOHOLDMASTER
+            if base in (HTU21D_TRIGGERTEMPCMD, HTU21D_TRIGGERHUMIDITYCMD):
+                resolution = self._userreg & HTU21D_RES_MASK
+                hum_time, temp_time = HTU21D_CONVERSION_TIMES[resolution]
+                delay = temp_time if base == HTU21D_TRIGGERTEMPCMD else hum_time
+                raw = self._raw(base)
+                frame = [raw >> 8, raw & 0xFF]
+                self._pending = (frame + [crc8(frame)],
+                                 time.time() + delay * self.conversion_scale)
+                self._hold = (command & HTU21D_NOHOLDMASTER) == HTU21D_HOLDMASTER
+            elif command == HTU21D_READUSERCMD:
+                self._pending = ([self._userreg], 0.0)
+                self._hold = True
+            elif command == HTU21D_WRITEUSERREGCMD:
+                # Bit 6 (end of battery) is read only.
+                self._userreg = (data[1] & ~0x40) | (self._userreg & 0x40)
+            elif command == HTU21D_SOFTRESETCMD:
+                self._userreg = HTU21D_USERREG_DEFAULT
+                self._pending = None
+
+    def read_bytes(self, len):
+        self._check_open()
+        with self._lock:
+            self.reads += 1
+            if self._pending is None:
+                raise OSError(errno.EREMOTEIO, 'Simulated NACK: no measurement')
+            frame, ready = self._pending
+            wait = ready - time.time()
+            if wait > 0 and not self._hold:
+                raise OSError(errno.EREMOTEIO, 'Simulated NACK: measuring')
+            self._pending = None
+
+            error = self._forced.pop(0) if self._forced else None
+            if error is None and self._random.random() < self.io_error_rate:
+                error = 'io'
+            if error is None and self._random.random() < self.crc_error_rate:
+                error = 'crc'
+        if wait > 0:
+            # Hold master: the sensor stretches the clock until it is done.
+            time.sleep(wait)
+        if error == 'io':
+            raise OSError(errno.EREMOTEIO, 'Simulated I2C error')
+        frame = list(frame[:len])
+        if error == 'crc':
+            frame[-1] ^= 0xFF
+        return tuple(frame)
+
+    def write_read(self, command, length):
+        self.send_command(command)
+        return self.read_bytes(length)
@@ -19,143 +19,427 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import os
+import signal
 import sys
 import time
-import RPi.GPIO as GPIO
+import collections
+import threading
 import htu21d.htu21d as htu
-import sqlite3
+import chambers
+import control
+import datalog
+import filters
+import metrics
+import psychrometrics
+import ringbuffer
+import sampler
 import webpage.app as app
 import multiprocessing as mp
-#import wiringpi
 
 HUMIDITY_SETPOINT_HIGH = 92
 HUMIDITY_SETPOINT_LOW = 85
 ALLOWED_ERRORS = 10
 RELAY_PIN_BCM = 23
+FAN_PIN_BCM = 18
 
-dbconn = sqlite3.connect('/home/pi/datalog.db')
+# Set HUMIDITY_SIMULATE=1 to run against simulated chambers, sensors and
+# GPIO instead of the Pi's hardware, and HUMIDITY_DB to use another
+# database file. HUMIDITY_CONFIG names a JSON file listing the chambers
+# (see chambers.py); without one there is a single chamber set up from
+# the constants above. HUMIDITY_STORAGE=samplelog logs samples to the
+# memory-mapped files of samplelog.py, in the HUMIDITY_SAMPLELOG
+# directory, instead of the database (which then only names chambers).
+SIMULATE = os.environ.get('HUMIDITY_SIMULATE', '') not in ('', '0')
+DB_PATH = os.environ.get('HUMIDITY_DB', datalog.DB_PATH)
+CONFIG_PATH = os.environ.get('HUMIDITY_CONFIG')
+STORAGE = os.environ.get('HUMIDITY_STORAGE', 'sqlite')
+SAMPLELOG_DIR = os.environ.get('HUMIDITY_SAMPLELOG',
+                               os.path.splitext(DB_PATH)[0] + '-samples')
+
+CHAMBER_DEFAULTS = {
+    'relay_pin': RELAY_PIN_BCM,
+    'fan_pin': FAN_PIN_BCM,
+    'setpoint_low': HUMIDITY_SETPOINT_LOW,
+    'setpoint_high': HUMIDITY_SETPOINT_HIGH,
+}
+
+# Only chambers with PID control need wiringpi, for hardware PWM fans.
+if SIMULATE:
+    import simulation
+    GPIO = simulation.SimulatedGPIO()
+    wiringpi = simulation.SimulatedWiringPi()
+else:
+    import RPi.GPIO as GPIO
+    try:
+        import wiringpi
+    except ImportError:
+        wiringpi = None
+
+# Seconds between task timing reports. How often each chamber's sensor is
+# sampled is its sample_period, see chambers.py.
+REPORT_PERIOD = 600.0
+
+# Samples are committed by a background writer every DB_BATCH_SIZE
+# samples or DB_FLUSH_INTERVAL seconds, see datalog.DataWriter. Samples
+# older than DB_RETENTION seconds are moved to the compressed archive
+# (None keeps them all in the hot table).
+DB_BATCH_SIZE = 30
+DB_FLUSH_INTERVAL = 60.0
+DB_SYNCHRONOUS = 'NORMAL'
+DB_RETENTION = 14 * 24 * 3600.0
+
+dbconn = datalog.connect(DB_PATH)
 curs = dbconn.cursor()
+if STORAGE == 'samplelog':
+    import samplelog
+    writer = samplelog.SampleLogStore(SAMPLELOG_DIR, fsync_interval=DB_FLUSH_INTERVAL)
+elif STORAGE == 'sqlite':
+    writer = datalog.DataWriter(DB_PATH, batch_size=DB_BATCH_SIZE,
+                                flush_interval=DB_FLUSH_INTERVAL,
+                                synchronous=DB_SYNCHRONOUS,
+                                retention=DB_RETENTION)
+else:
+    raise ValueError('Unknown HUMIDITY_STORAGE {!r}, use sqlite or samplelog'.format(STORAGE))
 
 
-def add_data (temp, hum, setpoint, dbconn, curs):
-    curs.execute("INSERT INTO temps values(datetime('now'),"
-                 "(?), (?), (?))", (temp, hum, setpoint))
-    while True:
-        try:
-            dbconn.commit()
-            break
-        except sqlite3.OperationalError:
-            time.sleep(0.1)
-            print("deferred")
-
-def get_rows(curs):
-    curs.execute("select * from (select * from temps order by timestamp DESC limit 1000) order by timestamp ASC;")
-    rows = curs.fetchall()
+# Number of recent rows per chamber shared with the web app.
+ROW_WINDOW = 1000
+
+SENSOR_READ_SECONDS = metrics.Histogram(
+    'sensor_read_seconds', 'Time to read temperature and humidity from the sensor.',
+    ['chamber'])
+SENSOR_ERRORS = metrics.Counter(
+    'sensor_errors_total', 'Failed sensor reads by kind (I2C error, bad CRC or out of range).',
+    ['chamber', 'kind'])
+CONTROL_LATENCY_SECONDS = metrics.Histogram(
+    'control_latency_seconds', 'Time from a finished sensor read to the fogger and fan being switched for it.')
+RING_PUBLISH_SECONDS = metrics.Histogram(
+    'ring_publish_seconds', 'Time to publish a sample to the web app ring buffer.')
+HUMIDITY_OVERSHOOT = metrics.Histogram(
+    'humidity_overshoot_percent', 'How far humidity peaked above setpoint_high, per excursion, in %RH.',
+    ['chamber'], buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0))
+RELAY_CYCLES = metrics.Counter(
+    'relay_cycles_total', 'Times the fogger relay was switched on.', ['chamber'])
+RELAY_CYCLES_PER_HOUR = metrics.Gauge(
+    'relay_cycles_per_hour', 'Times the fogger relay was switched on in the last hour.', ['chamber'])
+HUMIDITY_VARIANCE = metrics.Gauge(
+    'humidity_variance', 'Exponentially weighted variance of the humidity readings, in %RH squared.',
+    ['chamber'])
+CONTROL_OUTPUT = metrics.Gauge(
+    'control_output', 'PID output of PID controlled chambers, from 0 to 1.', ['chamber'])
+
+
+def add_data (temp, hum, setpoint, ring, chamber=0, ts=None, relay=None, humidity_var=None):
+    """Queues a sample for the database and publishes it to the web app
+    through the shared ring buffer."""
+    row = (datalog.now_ms() if ts is None else ts, temp, hum, setpoint)
+    writer.add(temp, hum, setpoint, ts=row[0], chamber=chamber, relay=relay,
+               humidity_var=humidity_var)
+    with RING_PUBLISH_SECONDS.time():
+        ring.append(row)
+
+def get_rows(curs, chamber=0):
+    if STORAGE == 'samplelog':
+        rows = writer.get_rows(ROW_WINDOW, chamber)
+    else:
+        rows = datalog.get_rows(curs.connection, ROW_WINDOW, chamber)
     print("Fetched new database rows.")
     #print(rows)
     return rows
 
 def setup_pwm():
-    # wiringpi.pwmSetMode(0) # PWM_MODE_MS = 0
-    # wiringpi.wiringPiSetupGpio()
-    # wiringpi.pinMode(18, 2)      # pwm only works on GPIO port 18
-    # wiringpi.pwmSetClock(6)  # this parameters correspond to 25kHz
-    # wiringpi.pwmSetRange(128)
-    # wiringpi.pwmWrite(18, 0)   # minimum RPM
-
-    GPIO.setup(18, GPIO.OUT)
     GPIO.setup(24, GPIO.OUT)
     GPIO.output(24, False)
 
+class ChamberController(object):
+    """Sensor, relay, fan and control (see control.py) for one chamber.
+
+    PID chambers drive their fan through pwm, a control.HardwarePWM.
+    With config.log_interval set, control() acts on every reading but
+    log() only prints and stores the mean of each interval's readings.
+    """
+
+    def __init__(self, config, chamber_id, sensor, bus, ring, pwm=None):
+        self.config = config
+        self.name = config.name
+        self.chamber_id = chamber_id
+        self.sensor = sensor
+        self.bus = bus
+        self.ring = ring
+        self.error_tracker = 0
+        self.error = False
+        self.relay = None
+        self.failed = False
+        self.means = filters.IntervalMean(config.log_interval) if config.log_interval else None
+        self.pwm = pwm if config.control == 'pid' else None
+        self.policy = control.from_config(config)
+        self.filter = filters.SensorFilter(config.filter_window, config.filter_alpha)
+        self.overshoot = control.Overshoot(config.setpoint_high)
+        self.cycle_rate = control.CycleRate()
+
+        # Labelled children have to exist before the web process forks
+        # to be shared with it.
+        self.read_seconds = SENSOR_READ_SECONDS.labels(self.name)
+        self.io_errors = SENSOR_ERRORS.labels(self.name, 'io')
+        self.crc_errors = SENSOR_ERRORS.labels(self.name, 'crc')
+        self.range_errors = SENSOR_ERRORS.labels(self.name, 'range')
+        self.humidity_variance = HUMIDITY_VARIANCE.labels(self.name)
+        self.overshoots = HUMIDITY_OVERSHOOT.labels(self.name)
+        self.relay_cycles = RELAY_CYCLES.labels(self.name)
+        self.relay_cycles_per_hour = RELAY_CYCLES_PER_HOUR.labels(self.name)
+        if config.control == 'pid':
+            self.control_output = CONTROL_OUTPUT.labels(self.name)
+
+    @property
+    def setpoint(self):
+        """The humidity aimed at, as logged with each sample."""
+        return self.config.setpoint if self.config.control == 'pid' else self.config.setpoint_high
+
+    def setup(self):
+        GPIO.setup(self.config.relay_pin, GPIO.OUT)
+        if self.pwm is not None:
+            self.pwm.setup(self.config.fan_pin)
+        else:
+            GPIO.setup(self.config.fan_pin, GPIO.OUT)
+        try:
+            self.bus.configure(self.sensor, self.config)
+        except (OSError, htu.HTU21DException) as e:
+            print(self.name, "Could not set the sensor resolution:", e)
+
+    def relay_on(self):
+        GPIO.output(self.config.relay_pin, True)
+        self.relay = True
+
+    def relay_off(self):
+        GPIO.output(self.config.relay_pin, False)
+        self.relay = False
+
+    def recirc_fan_on(self):
+        self.set_fan(1.0)
+
+    def recirc_fan_off(self):
+        self.set_fan(0.0)
+
+    def set_fan(self, speed):
+        """Fan speed from 0 to 1; without PWM any speed above 0 is full."""
+        if self.pwm is not None:
+            self.pwm.write(self.config.fan_pin, speed)
+        else:
+            GPIO.output(self.config.fan_pin, speed > 0)
+
+    def read(self):
+        """Reads the sensor config.oversample times, back to back, and
+        returns the filtered reading, a filters.Filtered. Returns the last
+        exception instead if none of the reads could be used."""
+        error = None
+        accepted = False
+        for _ in range(self.config.oversample):
+            try:
+                with self.read_seconds.time():
+                    temperature, humidity, dewpoint = self.bus.read(self.sensor, self.config)
+            except (OSError, htu.HTU21DException) as e:
+                # OSError occurs when the I2C throws an error.
+                if isinstance(e, htu.HTU21DException):
+                    self.crc_errors.inc()
+                else:
+                    self.io_errors.inc()
+                error = e
+                continue
+            if self.filter.update(temperature, humidity):
+                accepted = True
+            else:
+                self.range_errors.inc()
+                error = filters.OutOfRange('Temp={:0.1f}* Humidity={:0.1f}% is out of range'
+                                           .format(temperature, humidity))
+        if not accepted:
+            return error
+        temperature, humidity, temperature_variance, humidity_variance = self.filter.value()
+        return filters.Filtered(temperature, humidity,
+                                float(psychrometrics.dewpoint(temperature, humidity)),
+                                temperature_variance, humidity_variance)
+
+    def control(self, reading, now=None):
+        """Switches the fogger and fan for a reading (or read error) taken
+        at now (time.monotonic()). Returns the filters.Filtered values and
+        what was done, for log()."""
+        if now is None:
+            now = time.monotonic()
+        relay = self.relay
+        failed = self.failed = isinstance(reading, Exception)
+        if not failed:
+            self.humidity_variance.set(reading.humidity_variance)
+            if self.error_tracker < 0:
+                self.error_tracker += 1
+            if self.error_tracker >= 0:
+                self.error = False
+        else:
+            print(self.name, reading)
+            reading = filters.Filtered(0, 0, 0, 0.0, 0.0)
+            self.error_tracker -= 1
+            if self.error_tracker < -ALLOWED_ERRORS:
+                self.error = True
+                print("Error!")
+
+        # A failed reading keeps the fogger and fan as they are, only too
+        # many in a row switch them off.
+        if self.error:
+            self.relay_off()
+            self.recirc_fan_off()
+            self.policy.stop(now)
+            action = "fan off"
+        else:
+            if failed:
+                on, speed = self.policy.hold(now)
+            else:
+                on, speed = self.policy.update(reading.humidity, now, reading.humidity_variance)
+            if on:
+                self.relay_on()
+            else:
+                self.relay_off()
+            self.set_fan(speed)
+            action = self.policy.action
+            if self.config.control == 'pid':
+                self.control_output.set(self.policy.pid.output)
+
+        if not failed:
+            overshoot = self.overshoot.update(reading.humidity)
+            if overshoot is not None:
+                self.overshoots.observe(overshoot)
+        if self.relay and not relay:
+            self.relay_cycles.inc()
+            self.cycle_rate.add(now)
+        self.relay_cycles_per_hour.set(self.cycle_rate.count(now))
+        return reading, action
+
+    def log(self, values, action, ts=None, now=None):
+        """Prints and stores what control() returned for a reading taken
+        at now (time.monotonic()) and ts (epoch ms). Failed and out of
+        range readings are not stored."""
+        relay = self.relay
+        samples = ''
+        if self.means is not None and not self.failed:
+            summary = self.means.add(time.monotonic() if now is None else now,
+                                     datalog.now_ms() if ts is None else ts, values, relay)
+            if summary is None:
+                return
+            ts, values, relay, count = summary
+            samples = '  ({} samples)'.format(count)
+        if not self.failed:
+            temperature, humidity, dewpoint = values[:3]
+            print('{0}: Temp={1:0.1f}*  Humidity={2:0.1f}%  Dewpoint={3:0.1f}*  Variance={4:0.3f}{5}'.format(self.name, temperature, humidity, dewpoint, values.humidity_variance, samples))
+            add_data(temperature, humidity, self.setpoint, self.ring,
+                     self.chamber_id, ts, relay, values.humidity_variance)
+
+        print("Tracker" + str(self.error_tracker) + "  Error: " + str(self.error))
+        print(action)
+
+def create_controllers(configs):
+    """A ChamberController for each chamber config, with sensors on the
+    same I2C bus sharing one chambers.SensorBus."""
+    buses = {}
+    controllers = []
+    pwm = None
+    if any(config.control == 'pid' for config in configs):
+        if wiringpi is None:
+            raise RuntimeError('PID control needs the wiringpi module for the PWM fans.')
+        pwm = control.HardwarePWM(wiringpi)
+    for config in configs:
+        if SIMULATE:
+            model = simulation.Chamber()
+            GPIO.attach(model, config.relay_pin, config.fan_pin)
+            wiringpi.attach(model, config.fan_pin)
+            sensor = simulation.make_sensor(model)
+            mux_factory = simulation.SimulatedMux
+        else:
+            sensor = htu.HTU21D(config.bus, config.address, persistent=True)
+            mux_factory = chambers.TCA9548A
+        if config.bus not in buses:
+            buses[config.bus] = chambers.SensorBus(config.bus, mux_factory)
+
+        chamber_id = datalog.chamber_id(dbconn, config.name)
+        # Recent rows are shared with the web app through a ring buffer
+        # in shared memory, which needs the web process to be forked.
+        ring = ringbuffer.SampleRing(ROW_WINDOW)
+        ring.extend(get_rows(curs, chamber_id))
+        controllers.append(ChamberController(config, chamber_id, sensor,
+                                             buses[config.bus], ring, pwm))
+    return controllers
+
 def main():
-    queue = mp.Queue()
+    configs = chambers.load_config(CONFIG_PATH, **CHAMBER_DEFAULTS)
+    controllers = create_controllers(configs)
+    rings = collections.OrderedDict((c.name, c.ring) for c in controllers)
+
     # Start Flask Webapp in a different process.
-    p = mp.Process(target=app.launch_app, args=(queue,))
+    p = mp.get_context('fork').Process(
+        target=app.launch_app,
+        args=(rings, DB_PATH, SAMPLELOG_DIR if STORAGE == 'samplelog' else None))
     p.start()
 
+    writer.start()
+
     # Set up Relay Output.
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(RELAY_PIN_BCM, GPIO.OUT)
+    for controller in controllers:
+        controller.setup()
     setup_pwm()
 
-    def relay_on():
-        GPIO.output(RELAY_PIN_BCM, True)
-
-    def relay_off():
-        GPIO.output(RELAY_PIN_BCM, False)
-
-    def recirc_fan_on():
-        GPIO.output(18, True)
-
-    def recirc_fan_off():
-        GPIO.output(18, False)
-
-    sensor = htu.HTU21D()
-
     # Signal to the outside world that the program has started.
-    relay_on()
-    recirc_fan_on()
+    for controller in controllers:
+        controller.relay_on()
+        controller.recirc_fan_on()
     time.sleep(2)
-    relay_off()
-    recirc_fan_off()
+    for controller in controllers:
+        controller.relay_off()
+        controller.recirc_fan_off()
 
-    last_read_time = 0
+    # Sensors are read on the sampler's thread, those on different buses
+    # in parallel. Each reading is handed over through a latest-value
+    # slot, and this thread switches the relays as soon as it arrives,
+    # before printing and logging it.
+    new_reading = threading.Event()
+    slots = collections.OrderedDict((c, sampler.LatestValue(new_reading)) for c in controllers)
+    groups = collections.OrderedDict()
+    for controller, slot in slots.items():
+        key = (controller.config.sample_period, controller.bus)
+        groups.setdefault(key, []).append((controller.read, slot))
+    sensors = sampler.Sampler([(period, group) for (period, bus), group in groups.items()])
 
-    rows = []
-    row_refresh_time = 0
-    error_tracker = 0
-    error = False
+    def report():
+        for name, stats in sensors.tasks.stats().items():
+            print("Task {}: {}".format(name, stats))
 
-    try:
-        while True:
+    sensors.tasks.every(REPORT_PERIOD, report, delay=REPORT_PERIOD)
+    sensors.start()
 
-          if time.time() > row_refresh_time + 2:
-            rows = get_rows(curs)
-            row_refresh_time = time.time()
-
-          if queue.empty():
-            queue.put(rows)
-            print("Put latest rows in queue.")
-
-          if time.time() > last_read_time + 2:
-              try:
-                  temperature = sensor.read_temperature()
-                  humidity = sensor.read_humidity()
-                  dewpoint = sensor.dewpoint(temperature, humidity)
-                  if error_tracker < 0:
-                      error_tracker += 1
-                  if error_tracker >= 0:
-                      error = False
-              except OSError as e:
-                  # OSError occurs when the I2C throws an error.
-                  print(e)
-                  temperature = 0
-                  humidity = 0
-                  dewpoint = 0
-                  error_tracker -= 1
-                  if error_tracker < -ALLOWED_ERRORS:
-                      error = True
-                      print("Error!")
-
-              if humidity is not None and temperature is not None:
-                  print('Temp={0:0.1f}*  Humidity={1:0.1f}%  Dewpoint={2:0.1f}*'.format(temperature, humidity, dewpoint))
-                  add_data(temperature, humidity, HUMIDITY_SETPOINT_HIGH, dbconn, curs)
-                  last_read_time = time.time()
-
-              print("Tracker" + str(error_tracker) + "  Error: " + str(error))
-              if error or humidity > HUMIDITY_SETPOINT_HIGH:
-                relay_off()
-                recirc_fan_off()
-                print("fan off")
-              elif humidity < HUMIDITY_SETPOINT_LOW:
-                relay_on()
-                recirc_fan_on()
-                print("fan on")
-              else:
-                print("else...")
+    # systemctl stop sends SIGTERM: shut down as for Ctrl-C, so the
+    # samples still batched in the writer are not lost.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+    seen = dict((c, 0) for c in controllers)
+    try:
+        while True:
+            new_reading.wait()
+            new_reading.clear()
+            for controller, slot in slots.items():
+                seq, reading = slot.get()
+                if seq == seen[controller]:
+                    continue
+                seen[controller] = seq
+                values, action = controller.control(reading.value, reading.monotonic)
+                CONTROL_LATENCY_SECONDS.observe(time.monotonic() - reading.monotonic)
+                controller.log(values, action, reading.ts, reading.monotonic)
     except KeyboardInterrupt:
+        pass
+    finally:
+        sensors.stop()
+        # GPIO.cleanup() leaves hardware PWM running at the last duty.
+        for controller in controllers:
+            controller.relay_off()
+            controller.recirc_fan_off()
         GPIO.cleanup()
+        writer.close()
 
 if __name__ == "__main__":
     main()
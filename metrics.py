@@ -0,0 +1,192 @@
+'''
+Prometheus style metrics for the controller and the web app.
+
+Counters, gauges and histograms keep their values in multiprocessing
+shared memory, so a metric created at import time (before the web
+process is forked) can be updated by the controller and served by the
+web app at /metrics. Children of labelled metrics are created on first
+use and are only shared if that happens before the fork; in practice
+labels are used for web request metrics, which are updated and served by
+the web process itself.
+
+Each metric should only be updated from one process. Updates within a
+process are serialised with a lock, which costs well under a
+microsecond.
+'''
+import bisect
+import multiprocessing as mp
+import threading
+import time
+
+# Latency buckets in seconds, from 100 us to 10 s.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for labels, child in metric.children():
+                lines.extend(child.samples(metric.name, metric.labelnames, labels))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, **kwargs):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._child(**kwargs)
+        registry.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child(**self._kwargs))
+        return child
+
+    def children(self):
+        return sorted(self._children.items())
+
+    # Unlabelled metrics proxy to their only child.
+    def __getattr__(self, attr):
+        if attr.startswith('_') or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self._value = mp.RawValue('d', 0.0)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value.value += amount
+
+    def set(self, value):
+        with self._lock:
+            self._value.value = value
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def samples(self, name, labelnames, labels):
+        return ['{}{} {}'.format(name, _format_labels(labelnames, labels),
+                                 _format_value(self._value.value))]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _child(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _child(self):
+        return _CounterValue()
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Per bucket counts (the last one is +Inf), then sum.
+        self._values = mp.RawArray('d', len(buckets) + 2)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._values[i] += 1
+            self._values[-1] += value
+
+    def time(self):
+        """Context manager observing the duration of its block."""
+        return _Timer(self)
+
+    @property
+    def count(self):
+        return sum(self._values[:-1])
+
+    @property
+    def sum(self):
+        return self._values[-1]
+
+    def samples(self, name, labelnames, labels):
+        values = self._values[:]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], values[:-1]):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labelnames, labels, [('le', _format_value(bound))]),
+                _format_value(cumulative)))
+        label_text = _format_labels(labelnames, labels)
+        lines.append('{}_sum{} {}'.format(name, label_text, _format_value(values[-1])))
+        lines.append('{}_count{} {}'.format(name, label_text, _format_value(cumulative)))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self._start
+        self._histogram.observe(self.elapsed)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames, registry,
+                                        buckets=tuple(sorted(buckets)))
+
+    def _child(self, buckets):
+        return _HistogramValue(buckets)
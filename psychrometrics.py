@@ -0,0 +1,68 @@
+'''
+Psychrometrics over NumPy arrays.
+
+Dew point, absolute humidity and vapour pressure deficit from
+temperature (degrees C) and relative humidity (%RH), for single
+readings or whole arrays of them at once. Saturation vapour pressure
+uses the Magnus formula with the constants of HTU21D.dewpoint(): over
+water (a = 7.5, b = 237.3) from 0 degrees C up, over ice (a = 7.6,
+b = 240.7) below.
+
+DERIVED names the quantities /data can add to its series.
+'''
+import collections
+
+import numpy as np
+
+MAGNUS_E0 = 6.1078  # hPa, saturation vapour pressure at 0 degrees C
+MAGNUS_WATER = (7.5, 237.3)
+MAGNUS_ICE = (7.6, 240.7)
+
+# Water vapour density (g/m^3) per hPa of vapour pressure per kelvin:
+# 100 Pa/hPa * 1000 g/kg / 461.5 J/(kg K), the specific gas constant of
+# water vapour.
+VAPOUR_DENSITY = 216.68
+
+
+def _magnus(t):
+    """a and b of the Magnus formula for temperatures t."""
+    water = t >= 0.0
+    return (np.where(water, MAGNUS_WATER[0], MAGNUS_ICE[0]),
+            np.where(water, MAGNUS_WATER[1], MAGNUS_ICE[1]))
+
+
+def saturation_vapour_pressure(t):
+    """Saturation vapour pressure in hPa at temperatures t."""
+    t = np.asarray(t, dtype=float)
+    a, b = _magnus(t)
+    return MAGNUS_E0 * 10.0 ** (a * t / (b + t))
+
+
+def dewpoint(t, h):
+    """Dew point in degrees C; NaN where h is not above 0."""
+    t = np.asarray(t, dtype=float)
+    h = np.asarray(h, dtype=float)
+    a, b = _magnus(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = np.log10(np.where(h > 0, h, np.nan) / 100.0) + a * t / (b + t)
+        return b * v / (a - v)
+
+
+def absolute_humidity(t, h):
+    """Water vapour per volume of air, in g/m^3."""
+    t = np.asarray(t, dtype=float)
+    h = np.asarray(h, dtype=float)
+    return VAPOUR_DENSITY * h / 100.0 * saturation_vapour_pressure(t) / (t + 273.15)
+
+
+def vapour_pressure_deficit(t, h):
+    """How much more water vapour the air could hold, in kPa."""
+    h = np.asarray(h, dtype=float)
+    return saturation_vapour_pressure(t) * (1.0 - h / 100.0) / 10.0
+
+
+DERIVED = collections.OrderedDict([
+    ('dewpoint', dewpoint),
+    ('absolute_humidity', absolute_humidity),
+    ('vpd', vapour_pressure_deficit),
+])
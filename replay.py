@@ -0,0 +1,340 @@
+'''
+Chamber control compared on recorded data.
+
+    python replay.py [datalog.db] [--chamber main] [--hours 24]
+    python replay.py --samplelog datalog-samples [--chamber main]
+    python replay.py --control pid --sweep kp=0.02,0.05,0.1 --sweep ki=0,0.0001
+
+fits a first order plus dead time model (control.fit_fopdt) to the
+samples in the data log, then runs every kind of control against a
+simulation.Chamber following that model, in virtual time, and prints
+how well each kept the humidity between the setpoints and how often it
+switched the relay, next to the same figures for the recording itself.
+Each control also replays the recorded humidity, open loop, to show how
+often it would have switched on the readings actually seen.
+
+Controls run as in humidity_controller: the chamber settings build the
+sensor filter and control (see chambers.py), and the readings go
+through the filter every sample_period seconds. Nothing sleeps, so a
+simulated day takes seconds. --sweep runs the --control chosen for
+every combination of the settings given, across a process pool.
+The data log is opened read-only; one with an older schema is migrated
+in a copy in memory, never in place.
+
+Sample logs (HUMIDITY_STORAGE=samplelog) record the relay state with
+each sample. The data log does not, so the fit uses the states
+hysteresis control would have had: on below the logged setpoint minus
+--band until above the logged setpoint. Recordings also have stretches
+no model explains (an empty fogger, a saturated sensor), so the model is
+fitted to each --window hours on its own and the median of the fits
+that succeed is used. Readings the sensor filter would reject are left
+out first, and so are fits no controller could be compared on: an
+ambient humidity inside the band, or no dead time found.
+'''
+import argparse
+import itertools
+import multiprocessing
+import sqlite3
+import time
+
+import numpy as np
+
+import chambers
+import control
+import datalog
+import filters
+import samplelog
+import simulation
+
+
+def open_readonly(path):
+    """A read-only connection to the data log at path. A database with an
+    older schema is copied into memory and the copy migrated, leaving the
+    file as it is."""
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    if datalog.schema_version(conn) < datalog.SCHEMA_VERSION:
+        copy = sqlite3.connect(':memory:')
+        conn.backup(copy)
+        conn.close()
+        conn = copy
+        datalog.migrate(conn)
+    return conn
+
+
+def load(conn, chamber=0, start=0, end=None):
+    """Times (seconds), temperatures, humidity and setpoints recorded for a
+    chamber."""
+    rows = np.array(datalog.get_range(conn, start, end, chamber), dtype=float).reshape(-1, 4)
+    return rows[:, 0] / 1000.0, rows[:, 1], rows[:, 2], rows[:, 3]
+
+
+def load_samplelog(store, chamber=0):
+    """Times (seconds), temperatures, humidity, setpoints and relay states
+    (NaN where unknown) from a samplelog.SampleLogStore."""
+    records = store.log(chamber).array()
+    relay = records['relay'].astype(float)
+    relay[records['relay'] == samplelog.RELAY_UNKNOWN] = np.nan
+    return (records['ts'] / 1000.0, records['temp'].astype(float), records['humidity'].astype(float),
+            records['setpoint'].astype(float), relay)
+
+
+def infer_relay(humidity, low, high):
+    """Relay states (1 or 0) of hysteresis control between low and high,
+    which may be arrays with a value per sample."""
+    state = np.where(humidity < low, 1.0, np.where(humidity > high, 0.0, np.nan))
+    # Carry the last decided state forward; off until the first one.
+    last = np.where(np.isnan(state), 0, np.arange(len(state)))
+    np.maximum.accumulate(last, out=last)
+    state = state[last]
+    state[np.isnan(state)] = 0.0
+    return state
+
+
+def plausible(temperature, humidity):
+    """Which readings pass the range check of filters.SensorFilter."""
+    return ((temperature >= filters.TEMPERATURE_RANGE[0]) &
+            (temperature <= filters.TEMPERATURE_RANGE[1]) &
+            (humidity >= filters.HUMIDITY_RANGE[0]) & (humidity <= filters.HUMIDITY_RANGE[1]))
+
+
+def fit_recording(t, humidity, relay, low, window=1800.0, max_dead_time=120.0):
+    """control.FOPDT with the median parameters of fits to each window
+    seconds of the recording, the number of windows that fitted and the
+    number of fits rejected; the model is None if none is left.
+
+    A fit is rejected if its ambient humidity is at or above low, where
+    the chamber would stay in band without fog, or its dead time is at
+    either end of the search, where the fit did not find one.
+    """
+    fits = []
+    rejected = 0
+    for start in np.arange(t[0], t[-1], window):
+        i, j = np.searchsorted(t, [start, start + window])
+        model = control.fit_fopdt(t[i:j], humidity[i:j], relay[i:j], max_dead_time)
+        if model is None:
+            continue
+        if model.ambient >= low or not 0 < model.dead_time < max_dead_time:
+            rejected += 1
+        else:
+            fits.append(model)
+    if not fits:
+        return None, 0, rejected
+    return control.FOPDT(*np.median(np.array(fits), axis=0).tolist()), len(fits), rejected
+
+
+def stats(t, humidity, relay, low, high):
+    """How well humidity was kept between low and high, and how often the
+    relay was switched on, for samples at times t (seconds)."""
+    overshoot = control.Overshoot(high)
+    peaks = [p for p in map(overshoot.update, humidity.tolist()) if p is not None]
+    hours = (t[-1] - t[0]) / 3600.0 if len(t) > 1 else 0.0
+    switch_ons = np.count_nonzero(np.diff(relay) > 0)
+    return {
+        'in_band': np.mean((humidity >= low) & (humidity <= high)),
+        'min': humidity.min(),
+        'max': humidity.max(),
+        'overshoots': len(peaks),
+        'max_overshoot': max(peaks) if peaks else 0.0,
+        'cycles_per_hour': switch_ons / hours if hours else 0.0,
+    }
+
+
+class Controller(object):
+    """The sensor filter and control of a humidity_controller
+    ChamberController, without the hardware."""
+
+    def __init__(self, config):
+        self.filter = filters.SensorFilter(config.filter_window, config.filter_alpha)
+        self.policy = control.from_config(config)
+
+    def update(self, temperature, humidity, now):
+        """(relay on, fan speed) for a raw reading taken at now. Like a
+        failed reading in the controller, an out of range one keeps them
+        as they are."""
+        if not self.filter.update(temperature, humidity):
+            return self.policy.hold(now)
+        humidity, variance = self.filter.value()[1::2]
+        return self.policy.update(humidity, now, variance)
+
+
+def simulate(config, model, hours=24.0, warmup=3600.0, seed=0):
+    """Runs the control of a chambers.ChamberConfig against a simulated
+    chamber following model for hours of virtual time, sampled every
+    config.sample_period seconds, and returns its stats() after the
+    first warmup seconds."""
+    now = [0.0]
+    low, high = config.setpoint_low, config.setpoint_high
+    chamber = simulation.Chamber(humidity=(low + high) / 2.0, ambient_humidity=model.ambient,
+                                 fog_rate=model.gain, leak_time=model.tau,
+                                 dead_time=model.dead_time, clock=lambda: now[0], seed=seed)
+    controller = Controller(config)
+    steps = int((hours * 3600 + warmup) / config.sample_period)
+    t = np.arange(steps) * config.sample_period
+    humidity = np.empty(steps)
+    relay = np.empty(steps)
+    for i in range(steps):
+        now[0] = t[i]
+        temperature, humidity[i] = chamber.read()
+        on, speed = controller.update(temperature, humidity[i], t[i])
+        chamber.set_relay(on)
+        chamber.set_fan(speed)
+        relay[i] = on
+    keep = t >= warmup
+    return stats(t[keep], humidity[keep], relay[keep], low, high)
+
+
+def replay(config, t, temperature, humidity):
+    """Relay states the control of a chambers.ChamberConfig chooses for
+    readings recorded at times t (seconds), open loop: the recording does
+    not respond to them."""
+    controller = Controller(config)
+    relay = np.empty(len(t))
+    for i, (now, temp, hum) in enumerate(zip(t.tolist(), temperature.tolist(),
+                                             humidity.tolist())):
+        relay[i] = controller.update(temp, hum, now)[0]
+    return relay
+
+
+def _simulate(args):
+    settings, model, hours, seed = args
+    return simulate(chambers.ChamberConfig(**settings), model, hours, seed=seed)
+
+
+def sweep(settings, grid, model, hours=24.0, seed=0, processes=None):
+    """Simulates the chamber settings with every combination of the values
+    in grid, a dict of setting name to list of values, in a process pool.
+    Returns a list of (combination, stats()) pairs, combination being a
+    dict of the swept settings."""
+    names = sorted(grid)
+    combinations = [dict(zip(names, values))
+                    for values in itertools.product(*[grid[name] for name in names])]
+    jobs = []
+    for combination in combinations:
+        job = dict(settings)
+        job.update(combination)
+        # Check each combination here rather than in a worker.
+        chambers.ChamberConfig(**job)
+        jobs.append((job, model, hours, seed))
+    with multiprocessing.Pool(processes) as pool:
+        return list(zip(combinations, pool.map(_simulate, jobs)))
+
+
+def parse_sweep(specs):
+    """{name: [values]} from NAME=V1,V2,... strings, with values of the
+    type of the chambers.ChamberConfig default."""
+    grid = {}
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in chambers.ChamberConfig.DEFAULTS or not values:
+            raise ValueError('expected a chamber setting and values, like kp=0.02,0.05,'
+                             ' not {!r}'.format(spec))
+        default = chambers.ChamberConfig.DEFAULTS[name]
+        kind = type(default) if isinstance(default, (int, float, str)) else float
+        grid[name] = [kind(value) for value in values.split(',')]
+    return grid
+
+
+STATS_HEADER = ('in band', 'min', 'max', 'overshoots', 'max overshoot', 'cycles per hour')
+
+
+def print_stats(name, result, width=12):
+    print('{:<{}} {:>7.1%} {:>6.1f} {:>6.1f} {:>10d} {:>13.2f} {:>15.1f}'.format(
+        name, width, result['in_band'], result['min'], result['max'], result['overshoots'],
+        result['max_overshoot'], result['cycles_per_hour']))
+
+
+def print_header(name, width=12):
+    print('{:<{}} {:>7} {:>6} {:>6} {:>10} {:>13} {:>15}'.format(name, width, *STATS_HEADER))
+
+
+def main():
+    defaults = chambers.ChamberConfig()
+    parser = argparse.ArgumentParser(description='Compare chamber control on recorded data')
+    parser.add_argument('db', nargs='?', default=datalog.DB_PATH)
+    parser.add_argument('--samplelog', metavar='DIR',
+                        help='read samples and relay states from this sample log directory')
+    parser.add_argument('--chamber', default=defaults.name)
+    parser.add_argument('--band', type=float, default=3.0,
+                        help='hysteresis band below the logged setpoint the recording was made with')
+    parser.add_argument('--low', type=float, default=defaults.setpoint_low)
+    parser.add_argument('--high', type=float, default=defaults.setpoint_high)
+    parser.add_argument('--window', type=float, default=0.5, help='hours of recording per fit')
+    parser.add_argument('--hours', type=float, default=24.0, help='simulated hours per control')
+    parser.add_argument('--control', choices=chambers.ChamberConfig.CONTROLS, default='pid',
+                        help='control to sweep')
+    parser.add_argument('--sweep', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help='chamber setting values to sweep, may be repeated')
+    parser.add_argument('--processes', type=int, help='sweep processes (default: one per CPU)')
+    args = parser.parse_args()
+    try:
+        grid = parse_sweep(args.sweep)
+    except ValueError as e:
+        parser.error(str(e))
+
+    conn = open_readonly(args.db)
+    chamber = datalog.chamber_names(conn)
+    ids = dict((name, i) for i, name in chamber.items())
+    if args.chamber not in ids:
+        parser.error('no chamber {!r} in {}'.format(args.chamber, args.db))
+    if args.samplelog:
+        t, temperature, humidity, setpoint, relay = load_samplelog(
+            samplelog.SampleLogStore(args.samplelog), ids[args.chamber])
+        unknown = np.isnan(relay)
+        relay[unknown] = infer_relay(humidity, setpoint - args.band, setpoint)[unknown]
+    else:
+        t, temperature, humidity, setpoint = load(conn, ids[args.chamber])
+        relay = infer_relay(humidity, setpoint - args.band, setpoint)
+    valid = plausible(temperature, humidity)
+    if not valid.all():
+        print('Dropped {} readings out of range.'.format(np.count_nonzero(~valid)))
+        t, temperature, humidity, setpoint, relay = (
+            a[valid] for a in (t, temperature, humidity, setpoint, relay))
+    model, fitted, rejected = fit_recording(t, humidity, relay, args.low, args.window * 3600)
+    if model is None:
+        raise SystemExit('The recording does not determine a model of the chamber'
+                         ' ({} fits rejected).'.format(rejected))
+    print('{} samples over {:.1f} h, {} windows fitted ({} rejected): gain {:.3f} %RH/s,'
+          ' tau {:.0f} s, dead time {:.0f} s, ambient {:.1f}%'.format(
+              len(t), (t[-1] - t[0]) / 3600, fitted, rejected, model.gain, model.tau,
+              model.dead_time, model.ambient))
+    print()
+    started = time.time()
+    settings = dict(setpoint_low=args.low, setpoint_high=args.high)
+    if grid:
+        settings['control'] = args.control
+        results = sweep(settings, grid, model, args.hours, processes=args.processes)
+        names = sorted(grid)
+        labels = [' '.join('{}={}'.format(name, combination[name]) for name in names)
+                  for combination, _ in results]
+        title = 'settings' if 'control' in grid else args.control
+        width = max(len(label) for label in labels + [title])
+        print_header(title, width)
+        for label, (_, result) in zip(labels, results):
+            print_stats(label, result, width)
+        simulated = len(results) * args.hours
+    else:
+        print_header('control')
+        recorded = setpoint >= args.low
+        print_stats('recorded', stats(t[recorded], humidity[recorded], relay[recorded],
+                                      args.low, args.high))
+        for kind in chambers.ChamberConfig.CONTROLS:
+            settings['control'] = kind
+            print_stats(kind, simulate(chambers.ChamberConfig(**settings), model, args.hours))
+        print()
+        print('Switching on the recorded humidity, open loop:')
+        print('{:<12} {:>7} {:>15}'.format('control', 'on', 'cycles per hour'))
+        hours = (t[-1] - t[0]) / 3600.0
+        for kind in chambers.ChamberConfig.CONTROLS:
+            settings['control'] = kind
+            states = replay(chambers.ChamberConfig(**settings), t, temperature, humidity)
+            print('{:<12} {:>7.1%} {:>15.1f}'.format(
+                kind, states.mean(), np.count_nonzero(np.diff(states) > 0) / hours))
+        simulated = len(chambers.ChamberConfig.CONTROLS) * args.hours
+    elapsed = time.time() - started
+    print()
+    print('{:.0f} simulated hours in {:.1f} s, {:.0f} times real time.'.format(
+        simulated, elapsed, simulated * 3600 / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+'''
+Shared memory ring buffer of recent samples.
+
+The controller appends each sample once; any number of readers in other
+processes (the web app and its request threads) take snapshots without
+locks, pickling or blocking the writer.
+
+The buffer is an anonymous shared mmap, so it has to be created before
+the reader processes are forked. Layout, all little-endian:
+
+    header: count (uint64), capacity (uint64)
+    slots:  capacity + 1 records of ts (int64 epoch ms), temp, humidity,
+            setpoint (float64)
+
+count is the number of samples ever appended, which doubles as a
+sequence number. Sample i lives in slot i % (capacity + 1); the spare
+slot is the one the writer may be filling at any moment. There is a single
+writer; it fills the slot first and publishes it by bumping count.
+Readers copy the slots they want, re-read count and throw away anything
+the writer may have overwritten during the copy (a seqlock).
+'''
+import mmap
+import struct
+
+HEADER = struct.Struct('<QQ')
+RECORD = struct.Struct('<qddd')
+COUNT = struct.Struct('<Q')
+# NumPy dtype of RECORD, for columns().
+RECORD_DTYPE = [('ts', '<i8'), ('temp', '<f8'), ('humidity', '<f8'), ('setpoint', '<f8')]
+
+
+class SampleRing(object):
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._slots = capacity + 1
+        self._mm = mmap.mmap(-1, HEADER.size + self._slots * RECORD.size)
+        HEADER.pack_into(self._mm, 0, 0, capacity)
+
+    @property
+    def count(self):
+        """Sequence number of the newest sample (samples ever appended)."""
+        return COUNT.unpack_from(self._mm, 0)[0]
+
+    def _offset(self, i):
+        return HEADER.size + (i % self._slots) * RECORD.size
+
+    def append(self, row):
+        """Appends a (ts, temp, humidity, setpoint) sample. Writer only."""
+        i = self.count
+        RECORD.pack_into(self._mm, self._offset(i), *row[:4])
+        COUNT.pack_into(self._mm, 0, i + 1)
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def _ts(self, i):
+        return RECORD.unpack_from(self._mm, self._offset(i))[0]
+
+    def _first_after(self, lo, hi, since):
+        """Index of the first sample in [lo, hi) with ts > since."""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ts(mid) > since:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _snapshot(self, since, limit):
+        """Copy of the records rows() returns and how many of them (from
+        the front) the writer overwrote during the copy."""
+        end = self.count
+        start = max(0, end - self.capacity)
+        if since is not None:
+            start = self._first_after(start, end, since)
+        if limit is not None:
+            start = max(start, end - limit)
+        if start >= end:
+            return b'', 0
+
+        first = self._offset(start)
+        last = self._offset(end - 1) + RECORD.size
+        if first < last:
+            data = self._mm[first:last]
+        else:
+            data = self._mm[first:] + self._mm[HEADER.size:last]
+
+        # Anything the writer got to while we were copying is garbage.
+        return data, max(0, self.count - self.capacity - start)
+
+    def rows(self, since=None, limit=None):
+        """Snapshot of the buffered samples, oldest first.
+
+        With since (an epoch ms cursor) only newer samples are returned,
+        found by binary search so the cost is O(log n + k).
+        """
+        data, overwritten = self._snapshot(since, limit)
+        rows = list(RECORD.iter_unpack(data))
+        if overwritten > 0:
+            del rows[:overwritten]
+        return rows
+
+    def columns(self, since=None, limit=None):
+        """The same snapshot as rows() as a NumPy structured array with
+        ts, temp, humidity and setpoint fields, built without a Python
+        object per sample."""
+        import numpy
+        data, overwritten = self._snapshot(since, limit)
+        return numpy.frombuffer(data, dtype=RECORD_DTYPE)[overwritten:]
+
+    def close(self):
+        self._mm.close()
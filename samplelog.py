@@ -0,0 +1,274 @@
+'''
+Memory-mapped append-only sample log.
+
+An alternative to the SQLite data log for high sample rates: every
+sample is one fixed width binary record appended to a memory-mapped
+file, so logging costs a struct pack into memory instead of a B-tree
+insert, and reads are a binary search on the timestamps plus a slice of
+the mapping.
+
+File layout, all little-endian:
+
+    header (64 bytes): magic b'HUMLOG\\0\\0', version (uint32), record
+                       size (uint32), count (uint64), zero padding
+    records:           ts (int64 epoch ms), temp, humidity, setpoint
+                       (float64), relay (uint8, 255 if unknown), 3 bytes
+                       padding, humidity variance (float32, NaN if
+                       unknown; 0 in logs written before it was added)
+
+count is the number of complete records. A record is written before
+count is bumped, so a crash loses at most the samples since the last
+flush and never leaves a torn record behind. The file grows in steps of
+grow records and is flushed to disk by SampleLogStore every
+fsync_interval seconds.
+
+Timestamps are kept non-decreasing for the binary search: a sample
+stamped before the previous one (the clock was stepped back) is logged
+with the previous sample's timestamp.
+
+SampleLog.array() views records as a NumPy structured array without
+copying them; NumPy is only imported when it is used.
+'''
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'HUMLOG\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+HEADER_SIZE = 64
+COUNT = struct.Struct('<Q')
+COUNT_OFFSET = 16
+RECORD = struct.Struct('<qdddB3xf')
+TS = struct.Struct('<q')
+RELAY_UNKNOWN = 255
+NAN = float('nan')
+
+_dtype = None
+
+
+def dtype():
+    """NumPy dtype of a record."""
+    global _dtype
+    if _dtype is None:
+        import numpy
+        _dtype = numpy.dtype({
+            'names': ['ts', 'temp', 'humidity', 'setpoint', 'relay', 'humidity_var'],
+            'formats': ['<i8', '<f8', '<f8', '<f8', 'u1', '<f4'],
+            'offsets': [0, 8, 16, 24, 32, 36],
+            'itemsize': RECORD.size,
+        })
+    return _dtype
+
+
+class SampleLog(object):
+    """One append-only log file. A single thread appends; reads can come
+    from any thread. A readonly log must exist already and cannot be
+    appended to."""
+
+    def __init__(self, path, grow=4096, readonly=False):
+        self.path = path
+        self.grow = grow
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        if readonly:
+            self._fd = os.open(path, os.O_RDONLY)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size == 0 and not readonly:
+            size = HEADER_SIZE + grow * RECORD.size
+            os.ftruncate(self._fd, size)
+            os.pwrite(self._fd, HEADER.pack(MAGIC, VERSION, RECORD.size, 0), 0)
+        self._mm = self._map(size)
+        magic, version, record_size, count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError('{} is not a version {} sample log'.format(path, VERSION))
+        self._capacity = (size - HEADER_SIZE) // RECORD.size
+        if count > self._capacity:
+            raise ValueError('{} is truncated: {} records in header, room for {}'
+                             .format(path, count, self._capacity))
+        self._count = count
+        self._last_ts = self._ts(count - 1) if count else None
+
+    @property
+    def count(self):
+        return self._count
+
+    def _map(self, size):
+        if self.readonly:
+            return mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        return mmap.mmap(self._fd, size)
+
+    def _ts(self, i):
+        return TS.unpack_from(self._mm, HEADER_SIZE + i * RECORD.size)[0]
+
+    def _grow(self):
+        with self._lock:
+            self._capacity += self.grow
+            size = HEADER_SIZE + self._capacity * RECORD.size
+            os.ftruncate(self._fd, size)
+            # The old mapping stays valid for any views still using it and
+            # is unmapped once they are gone.
+            self._mm = self._map(size)
+
+    def append(self, ts, temp, humidity, setpoint, relay=None, humidity_var=None):
+        if self._last_ts is not None and ts < self._last_ts:
+            ts = self._last_ts
+        if self._count == self._capacity:
+            self._grow()
+        i = self._count
+        RECORD.pack_into(self._mm, HEADER_SIZE + i * RECORD.size, ts, temp, humidity,
+                         setpoint, RELAY_UNKNOWN if relay is None else int(relay),
+                         NAN if humidity_var is None else humidity_var)
+        COUNT.pack_into(self._mm, COUNT_OFFSET, i + 1)
+        self._count = i + 1
+        self._last_ts = ts
+
+    def refresh(self):
+        """Picks up records appended through another process's mapping
+        of the file since this one was opened."""
+        count = COUNT.unpack_from(self._mm, COUNT_OFFSET)[0]
+        if count > self._capacity:
+            with self._lock:
+                size = os.fstat(self._fd).st_size
+                self._mm = self._map(size)
+                self._capacity = (size - HEADER_SIZE) // RECORD.size
+        self._count = count
+        self._last_ts = self._ts(count - 1) if count else None
+
+    def bisect(self, ts, hi=None):
+        """Index of the first record with a timestamp >= ts."""
+        lo = 0
+        hi = self._count if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ts(mid) < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bounds(self, start, end, limit):
+        count = self._count
+        i = 0 if start is None else self.bisect(start, count)
+        j = count if end is None else self.bisect(end, count)
+        if limit is not None:
+            i = max(i, j - limit)
+        return i, max(i, j)
+
+    def view(self, start=None, end=None, limit=None):
+        """memoryview of the records with start <= ts < end (the newest
+        limit of them), without copying."""
+        i, j = self._bounds(start, end, limit)
+        return memoryview(self._mm)[HEADER_SIZE + i * RECORD.size:HEADER_SIZE + j * RECORD.size]
+
+    def array(self, start=None, end=None, limit=None):
+        """The records of view() as a NumPy structured array (see dtype()).
+
+        The array shares memory with the log file; copy it to keep it
+        past the log's lifetime.
+        """
+        import numpy
+        return numpy.frombuffer(self.view(start, end, limit), dtype=dtype())
+
+    def rows(self, start=None, end=None, limit=None):
+        """(ts, temp, humidity, setpoint, relay, humidity_var) tuples,
+        oldest first."""
+        return list(RECORD.iter_unpack(self.view(start, end, limit)))
+
+    def flush(self):
+        if self.readonly:
+            return
+        with self._lock:
+            self._mm.flush()
+
+    def close(self):
+        self.flush()
+        try:
+            self._mm.close()
+        except BufferError:
+            # Views are still exported; the mapping goes away with them.
+            pass
+        os.close(self._fd)
+
+
+class SampleLogStore(object):
+    """A SampleLog per chamber in one directory, with the same add() /
+    start() / close() interface as datalog.DataWriter.
+
+    Appends happen right away on the caller's thread; a background thread
+    flushes the logs to disk every fsync_interval seconds. A readonly
+    store only reads the logs another process writes.
+    """
+
+    def __init__(self, directory, fsync_interval=10.0, grow=4096, readonly=False):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.grow = grow
+        self.readonly = readonly
+        self.flushes = 0
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='SampleLogStore', daemon=True)
+        if not readonly and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def log(self, chamber=0):
+        log = self._logs.get(chamber)
+        if log is None:
+            with self._lock:
+                log = self._logs.get(chamber)
+                if log is None:
+                    path = os.path.join(self.directory, 'chamber-{}.samples'.format(chamber))
+                    log = self._logs[chamber] = SampleLog(path, self.grow, self.readonly)
+        return log
+
+    def add(self, temp, hum, setpoint, ts=None, chamber=0, relay=None, humidity_var=None):
+        if ts is None:
+            ts = int(time.time() * 1000)
+        self.log(chamber).append(ts, temp, hum, setpoint, relay, humidity_var)
+
+    def get_rows(self, limit=1000, chamber=0):
+        """The newest (ts, temp, humidity, setpoint) rows, oldest first,
+        like datalog.get_rows()."""
+        return [row[:4] for row in self.log(chamber).rows(limit=limit)]
+
+    def get_range(self, start, end=None, chamber=0):
+        """Rows with start <= ts < end, oldest first, like
+        datalog.get_range()."""
+        return [row[:4] for row in self.log(chamber).rows(start, end)]
+
+    def array(self, start=None, end=None, chamber=0):
+        """SampleLog.array() of a chamber's log as written so far, also by
+        other processes (the web app reads the controller's logs). Empty
+        for a readonly store before the chamber's log is written."""
+        try:
+            log = self.log(chamber)
+        except FileNotFoundError:
+            import numpy
+            return numpy.empty(0, dtype())
+        log.refresh()
+        return log.array(start, end)
+
+    def flush(self):
+        for log in list(self._logs.values()):
+            log.flush()
+        self.flushes += 1
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            self.flush()
+
+    def close(self, timeout=None):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        for log in list(self._logs.values()):
+            log.close()
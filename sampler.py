@@ -0,0 +1,99 @@
+'''
+Sensor sampling thread for the humidity controller.
+
+The Sampler reads the sensors on its own thread, on scheduler.Scheduler
+deadline grids (one per sample period), and publishes every reading to
+a LatestValue slot as soon as it is available. The control loop waits
+on the slots' shared event and acts on new readings within
+milliseconds, however long the sensor reads, retries or anything else
+on the sampling side take.
+'''
+import collections
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import datalog
+import metrics
+import scheduler
+
+SAMPLE_CYCLE_SECONDS = metrics.Histogram(
+    'sample_cycle_seconds', 'Time to read the sensors sampled every period.')
+
+# value is whatever the read function returned (or raised), monotonic and
+# ts (epoch ms, from the wall clock) are when the read finished. The
+# monotonic time is for intervals and deadlines, ts for storage, so
+# stored times follow the wall clock when NTP sets it after boot.
+Reading = collections.namedtuple('Reading', 'value monotonic ts')
+
+
+class LatestValue(object):
+    """Single producer slot holding only the newest value.
+
+    publish() replaces the (sequence, value) pair with one reference
+    assignment, so neither side ever takes a lock or waits on the other.
+    A reader that falls behind skips straight to the newest value. All
+    slots given the same event set it on publish, so one consumer can
+    wait on many slots.
+    """
+
+    def __init__(self, event=None):
+        self.event = event or threading.Event()
+        self._latest = (0, None)
+
+    def publish(self, value):
+        self._latest = (self._latest[0] + 1, value)
+        self.event.set()
+
+    def get(self):
+        """(sequence, value); sequence is 0 until the first publish."""
+        return self._latest
+
+
+class Sampler(object):
+    """Runs read functions periodically on a background thread.
+
+    groups is a list of (period, [(read, slot), ...]) pairs, the reads of
+    a group run every period seconds. Groups with the same period run in
+    parallel (one per I2C bus), the reads within a group one after the
+    other. Each result, or the exception a read raised, is published to
+    its slot as a Reading. More periodic work can be added to self.tasks.
+    """
+
+    def __init__(self, groups):
+        self.groups = collections.OrderedDict()
+        for period, group in groups:
+            self.groups.setdefault(period, []).append(group)
+        self.tasks = scheduler.Scheduler()
+        for period, same in self.groups.items():
+            self.tasks.every(period, functools.partial(self.sample, same),
+                             name='sample every {:g} s'.format(period))
+        workers = max(len(same) for same in self.groups.values())
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._thread = threading.Thread(target=self.tasks.run, name='Sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.tasks.stop()
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def _read_group(self, group):
+        for read, slot in group:
+            try:
+                value = read()
+            except Exception as e:
+                value = e
+            slot.publish(Reading(value, time.monotonic(), datalog.now_ms()))
+
+    def sample(self, groups):
+        with SAMPLE_CYCLE_SECONDS.time():
+            if self._pool is None or len(groups) == 1:
+                for group in groups:
+                    self._read_group(group)
+            else:
+                list(self._pool.map(self._read_group, groups))
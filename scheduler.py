@@ -0,0 +1,97 @@
+'''
+Deadline based scheduler for periodic tasks.
+
+Tasks run on a fixed grid of deadlines on the monotonic clock
+(start, start + period, start + 2 * period, ...) rather than "period
+seconds after the last run finished", so sample timing does not drift.
+Between deadlines the thread sleeps until the next one is due instead of
+polling.
+
+A task that is still running when its next deadline passes has overrun.
+Its missed deadlines are skipped rather than run back to back, and both
+are counted per task.
+'''
+import threading
+import time
+
+
+class Task(object):
+    def __init__(self, name, period, fn, next_run):
+        self.name = name
+        self.period = period
+        self.fn = fn
+        self.next_run = next_run
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self.max_runtime = 0.0
+        self.total_runtime = 0.0
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'max_lateness': self.max_lateness,
+            'max_runtime': self.max_runtime,
+            'mean_runtime': self.total_runtime / self.runs if self.runs else 0.0,
+        }
+
+
+class Scheduler(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.tasks = []
+        self._wakeup = threading.Event()
+        self._running = False
+
+    def every(self, period, fn, name=None, delay=0.0):
+        """Runs fn every period seconds, the first time after delay."""
+        task = Task(name or fn.__name__, period, fn, self.clock() + delay)
+        self.tasks.append(task)
+        self._wakeup.set()
+        return task
+
+    def run_pending(self):
+        """Runs every task that is due. Returns the seconds until the next
+        deadline."""
+        for task in self.tasks:
+            now = self.clock()
+            if now < task.next_run:
+                continue
+            task.max_lateness = max(task.max_lateness, now - task.next_run)
+            try:
+                task.fn()
+            finally:
+                finished = self.clock()
+                runtime = finished - now
+                task.runs += 1
+                task.total_runtime += runtime
+                task.max_runtime = max(task.max_runtime, runtime)
+
+                task.next_run += task.period
+                if finished >= task.next_run:
+                    missed = int((finished - task.next_run) // task.period) + 1
+                    task.overruns += 1
+                    task.skipped += missed
+                    task.next_run += missed * task.period
+
+        if not self.tasks:
+            return None
+        return max(0.0, min(t.next_run for t in self.tasks) - self.clock())
+
+    def run(self):
+        """Runs tasks until stop() is called."""
+        self._running = True
+        while self._running:
+            timeout = self.run_pending()
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def stats(self):
+        return dict((task.name, task.stats()) for task in self.tasks)
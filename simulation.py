@@ -0,0 +1,207 @@
+'''
+Hardware-free backends for the humidity controller.
+
+Chamber is a simple model of the fogging chamber that responds to the
+relay (fogger) and recirculation fan, SimulatedGPIO stands in for
+RPi.GPIO and drives a Chamber, SimulatedWiringPi does the same for
+hardware PWM fans, and make_sensor() builds an HTU21D on a
+simulated bus that reads the Chamber. Together they let
+humidity_controller and the web app run on any Linux box, see
+HUMIDITY_SIMULATE in humidity_controller.py.
+'''
+import collections
+import random
+import threading
+import time
+
+import htu21d.htu21d as htu
+from htu21d.simulated import SimulatedHTU21DBus
+
+
+class Chamber(object):
+    """First order plus dead time humidity model.
+
+    While the fogger runs, humidity rises at fog_rate %RH per second
+    (scaled by how much air the fan moves through the fog), delayed by
+    dead_time seconds. All the while it relaxes towards ambient_humidity
+    with time constant leak_time. Temperature relaxes towards
+    ambient_temperature and is cooled slightly by fogging.
+
+    clock defaults to time.monotonic; pass a virtual clock to step the
+    model faster than real time.
+    """
+
+    def __init__(self, humidity=80.0, temperature=22.0, ambient_humidity=55.0,
+                 ambient_temperature=22.0, fog_rate=0.25, leak_time=900.0,
+                 dead_time=8.0, fan_still_fraction=0.3, noise=0.05,
+                 clock=time.monotonic, seed=None, step=0.5):
+        self.humidity = humidity
+        self.temperature = temperature
+        self.ambient_humidity = ambient_humidity
+        self.ambient_temperature = ambient_temperature
+        self.fog_rate = fog_rate
+        self.leak_time = leak_time
+        self.dead_time = dead_time
+        self.fan_still_fraction = fan_still_fraction
+        self.noise = noise
+        self.clock = clock
+        self.step = step
+        self.relay = False
+        self.fan = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._time = clock()
+        # (time, fog input) changes, for the dead time.
+        self._inputs = collections.deque([(self._time, 0.0)])
+
+    def _fog_input(self):
+        if not self.relay:
+            return 0.0
+        return self.fan_still_fraction + (1 - self.fan_still_fraction) * self.fan
+
+    def _delayed_input(self, t):
+        while len(self._inputs) > 1 and self._inputs[1][0] <= t - self.dead_time:
+            self._inputs.popleft()
+        return self._inputs[0][1]
+
+    def _advance(self):
+        now = self.clock()
+        while self._time < now:
+            dt = min(self.step, now - self._time)
+            u = self._delayed_input(self._time)
+            self.humidity += dt * (u * self.fog_rate -
+                                   (self.humidity - self.ambient_humidity) / self.leak_time)
+            self.humidity = max(0.0, min(100.0, self.humidity))
+            self.temperature += dt * ((self.ambient_temperature - self.temperature) / self.leak_time -
+                                      0.001 * u)
+            self._time += dt
+
+    def _set_inputs(self, relay=None, fan=None):
+        with self._lock:
+            self._advance()
+            if relay is not None:
+                self.relay = bool(relay)
+            if fan is not None:
+                self.fan = max(0.0, min(1.0, fan))
+            self._inputs.append((self._time, self._fog_input()))
+
+    def set_relay(self, on):
+        self._set_inputs(relay=on)
+
+    def set_fan(self, duty):
+        """Fan speed from 0 (off) to 1 (full)."""
+        self._set_inputs(fan=duty)
+
+    def read(self):
+        """(temperature, humidity) now, with sensor noise."""
+        with self._lock:
+            self._advance()
+            return (self.temperature + self._random.gauss(0, self.noise),
+                    self.humidity + self._random.gauss(0, self.noise))
+
+
+class SimulatedGPIO(object):
+    """The part of the RPi.GPIO API the controller uses.
+
+    Writes to a chamber's relay pin switch its fogger and writes to its
+    fan pin its fan; every other pin is just remembered in self.pins.
+    More chambers can be wired up with attach().
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, chamber=None, relay_pin=23, fan_pin=18):
+        self.relays = {}
+        self.fans = {}
+        self.pins = {}
+        self.mode = None
+        if chamber is not None:
+            self.attach(chamber, relay_pin, fan_pin)
+
+    def attach(self, chamber, relay_pin, fan_pin):
+        self.relays[relay_pin] = chamber
+        self.fans[fan_pin] = chamber
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=None):
+        self.pins[pin] = initial
+
+    def output(self, pin, value):
+        self.pins[pin] = bool(value)
+        if pin in self.relays:
+            self.relays[pin].set_relay(value)
+        elif pin in self.fans:
+            self.fans[pin].set_fan(1.0 if value else 0.0)
+
+    def input(self, pin):
+        return self.pins.get(pin)
+
+    def cleanup(self):
+        self.pins = {}
+
+
+class SimulatedWiringPi(object):
+    """The part of the wiringpi API control.HardwarePWM uses. PWM writes
+    to an attached fan pin set the chamber's fan speed."""
+
+    def __init__(self):
+        self.fans = {}
+        self.pins = {}
+        self.range = 1024
+
+    def attach(self, chamber, fan_pin):
+        self.fans[fan_pin] = chamber
+
+    def wiringPiSetupGpio(self):
+        return 0
+
+    def pinMode(self, pin, mode):
+        self.pins[pin] = 0
+
+    def pwmSetMode(self, mode):
+        pass
+
+    def pwmSetClock(self, divisor):
+        pass
+
+    def pwmSetRange(self, value):
+        self.range = value
+
+    def pwmWrite(self, pin, value):
+        self.pins[pin] = value
+        if pin in self.fans:
+            self.fans[pin].set_fan(float(value) / self.range)
+
+
+class SimulatedMux(object):
+    """Stand-in for chambers.TCA9548A."""
+
+    def __init__(self, busnum, address=0x70):
+        self.channel = None
+        self.selects = 0
+
+    def select(self, channel):
+        if channel != self.channel:
+            self.channel = channel
+            self.selects += 1
+
+    def close(self):
+        pass
+
+
+def make_sensor(chamber, **kwargs):
+    """An HTU21D reading chamber through a SimulatedHTU21DBus.
+
+    kwargs go to SimulatedHTU21DBus (conversion_scale, io_error_rate,
+    crc_error_rate, seed).
+    """
+    return htu.HTU21D(persistent=True, bus=SimulatedHTU21DBus(chamber, **kwargs))
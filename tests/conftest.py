@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The controller's modules live at the top of the repository, the HTU21D
+# driver in its own package directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'htu21d_py3')]
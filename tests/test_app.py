@@ -0,0 +1,123 @@
+import collections
+import time
+
+import numpy as np
+import pytest
+
+import datalog
+import ringbuffer
+from webpage import app as webapp
+
+
+def sample(i):
+    return (1558313995000 + 2000 * i, 20.0 + i % 3, 85.0 + i % 7, 92.0)
+
+
+def make_app(n=50):
+    ring = ringbuffer.SampleRing(100)
+    ring.extend(sample(i) for i in range(n))
+    return webapp.create_app(collections.OrderedDict([('main', ring)])).test_client()
+
+
+def test_etag_changes_across_restarts():
+    client = make_app()
+    etag = client.get('/data').headers['ETag']
+    assert client.get('/data', headers={'If-None-Match': etag}).status_code == 304
+    # A restarted controller refills its ring to the same count, with
+    # other samples.
+    restarted = make_app()
+    response = restarted.get('/data', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def unpack(body):
+    """Decodes the binary /data format as main.html does."""
+    count, unit, base, cursor, resolution = webapp.BINARY_HEADER.unpack_from(body, 0)
+    offset = webapp.BINARY_HEADER.size
+    columns = []
+    for _ in range(count):
+        n, = webapp.BINARY_COUNT.unpack_from(body, offset)
+        offset += webapp.BINARY_COUNT.size
+        ts = np.frombuffer(body, '<i4', n, offset).astype(np.int64) * unit + base
+        offset += 4 * n
+        values = np.frombuffer(body, '<f4', n, offset)
+        offset += 4 * n
+        columns.append((ts, values))
+    assert offset == len(body)
+    return None if cursor != cursor else cursor, resolution, columns
+
+
+def assert_same(columns, data, names):
+    assert len(columns) == len(names)
+    for (ts, values), name in zip(columns, names):
+        expected = np.array([np.nan if v is None else v for t, v in data[name]], dtype=float)
+        assert ts.tolist() == [t for t, v in data[name]]
+        np.testing.assert_allclose(values, expected.astype(np.float32), rtol=1e-6)
+
+
+@pytest.mark.parametrize('query', ['', '?since=1558313995000&derived=vpd,dewpoint'])
+def test_binary_matches_json_live(query):
+    client = make_app()
+    data = client.get('/data' + query).get_json()
+    response = client.get('/data' + query + ('&' if query else '?') + 'format=binary')
+    assert response.mimetype == webapp.BINARY_MIMETYPE
+    cursor, resolution, columns = unpack(response.data)
+    assert cursor == data['cursor'] and resolution == 0
+    names = ['temp', 'humidity'] + (['vpd', 'dewpoint'] if 'derived' in query else [])
+    assert_same(columns, data, names)
+
+
+@pytest.mark.parametrize('max_points, resolution', [(500, 0), (200, datalog.ROLLUP_1M)])
+def test_binary_matches_json_history(tmp_path, max_points, resolution):
+    path = str(tmp_path / 'datalog.db')
+    conn = datalog.connect(path)
+    with conn:
+        datalog.insert_samples(conn, [sample(i) + (0,) for i in range(3000)])
+    conn.close()
+    ring = ringbuffer.SampleRing(100)
+    client = webapp.create_app(collections.OrderedDict([('main', ring)]), path).test_client()
+    query = '/data?start={}&end={}&max_points={}&derived=absolute_humidity'.format(
+        sample(0)[0], sample(3000)[0], max_points)
+    data = client.get(query).get_json()
+    cursor, packed_resolution, columns = unpack(client.get(query, headers={
+        'Accept': webapp.BINARY_MIMETYPE}).data)
+    # Raw samples, or 1 minute rollups past OVERSAMPLE * max_points.
+    assert cursor is None and packed_resolution == data['resolution'] == resolution
+    assert 0 < len(columns[0][0]) <= max_points
+    assert_same(columns, data, ['temp', 'humidity', 'absolute_humidity'])
+
+
+def test_binary_time_unit():
+    day = 86400000
+    ts = np.array([0, 40 * day, 80 * day], dtype=np.int64) + 1558313995000
+    columns = collections.OrderedDict([('temp', (ts, np.array([1.0, np.nan, 3.0])))])
+    cursor, resolution, [(times, values)] = unpack(webapp.pack_columns(columns, 5, 60000))
+    assert (cursor, resolution) == (5, 60000)
+    # Spans past an int32 of milliseconds are sent in seconds.
+    assert times.tolist() == (ts // 1000 * 1000).tolist()
+    assert np.isnan(values[1]) and values[2] == 3.0
+
+
+def test_stream_resyncs_a_client_that_falls_behind():
+    ring = ringbuffer.SampleRing(100)
+    ring.extend(sample(i) for i in range(10))
+    broadcaster = webapp.Broadcaster({'main': ring}, poll_interval=0.01, queue_size=3)
+    fast = broadcaster.subscribe('main')
+    slow = broadcaster.subscribe('main')
+    time.sleep(0.05)
+    events = []
+    for i in range(10, 15):
+        ring.append(sample(i))
+        events.append(fast.get(timeout=5))
+    # One event per new sample, each with its cursor as the event id.
+    assert [e.split('\n')[0] for e in events] == ['id: {}'.format(sample(i)[0])
+                                                   for i in range(10, 15)]
+    assert webapp.RESYNC not in events
+    # The slow client's three queued events made way for a resync at the
+    # fourth, and it carries on from there.
+    assert [slow.get_nowait() for _ in range(slow.qsize())] == [webapp.RESYNC, events[-1]]
+    broadcaster.unsubscribe('main', slow)
+    ring.append(sample(15))
+    fast.get(timeout=5)
+    assert slow.empty()
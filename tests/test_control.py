@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+import chambers
+import control
+import simulation
+
+
+def test_pid_does_not_wind_up_while_saturated():
+    pid = control.PID(kp=0.02, ki=0.001)
+    # Far too dry for an hour: the output sits at its limit.
+    for now in range(0, 3600, 2):
+        output = pid.update(90.0, 60.0, now)
+    assert output == 1.0
+    # The integral stopped growing once it saturated the output...
+    assert 0.3 < pid.integral <= 1.0 - 0.02 * 30
+    # ...so the output falls as soon as humidity passes the setpoint.
+    assert pid.update(90.0, 91.0, 3600) < 0.5
+
+
+def test_pid_integral_holds_while_saturated_low():
+    pid = control.PID(kp=0.5, ki=0.01)
+    pid.integral = 0.3
+    for now in range(0, 600, 2):
+        assert pid.update(88.0, 95.0, now) == 0.0
+    assert pid.integral == 0.3
+
+
+def test_pid_hold_skips_the_gap():
+    pid = control.PID(kp=0.02, ki=0.001)
+    pid.update(90.0, 85.0, 0)
+    integral = pid.integral
+    pid.hold()
+    pid.update(90.0, 85.0, 1000)
+    assert pid.integral == integral
+
+
+def run(fogger, duties, end, step=1):
+    """Times the relay switched, for duties {time: duty} from then on."""
+    switches = []
+    duty = 0.0
+    state = False
+    for now in range(0, end, step):
+        duty = duties.get(now, duty)
+        if fogger.update(duty, now) != state:
+            state = not state
+            switches.append(now)
+    return switches
+
+
+def test_time_proportioner_windows():
+    fogger = control.TimeProportioner(100, min_on=10, min_off=10)
+    assert run(fogger, {0: 0.3}, 250) == [0, 30, 100, 130, 200, 230]
+
+
+def test_time_proportioner_min_on_and_min_off():
+    # On times under min_on are skipped, off times under min_off filled in.
+    assert run(control.TimeProportioner(100, min_on=10, min_off=10), {0: 0.05}, 300) == []
+    assert run(control.TimeProportioner(100, min_on=10, min_off=10), {0: 0.95}, 300) == [0]
+    # Dropping the duty does not cut an on time below min_on.
+    assert run(control.TimeProportioner(100, min_on=10), {0: 0.5, 2: 0.0}, 100) == [0, 10]
+
+
+def test_time_proportioner_min_off_after_off():
+    fogger = control.TimeProportioner(100, min_off=30)
+    assert run(fogger, {0: 0.95}, 90) == [0]
+    # Switched off by the controller, say after failed readings.
+    fogger.off(90)
+    # The next window starts at 100, the relay waits for min_off.
+    assert [now for now in range(90, 150) if fogger.update(0.5, now)][0] == 120
+
+
+def test_fan_split():
+    assert control.split(0.0, 0.5) == (0.0, 0.0)
+    assert control.split(0.25, 0.5) == (0.5, 0.0)
+    assert control.split(0.75, 0.5) == (1.0, 0.5)
+    for fan_split in (0, 1, 1.5):
+        with pytest.raises(ValueError):
+            chambers.ChamberConfig(control='pid', fan_split=fan_split)
+
+
+def test_fit_fopdt_recovers_the_chamber():
+    now = [0.0]
+    chamber = simulation.Chamber(humidity=70.0, ambient_humidity=55.0, fog_rate=0.05,
+                                 leak_time=900.0, dead_time=20.0, noise=0.02,
+                                 clock=lambda: now[0], seed=1)
+    chamber.set_fan(1.0)
+    t = np.arange(0.0, 4 * 3600, 2.0)
+    humidity = np.empty(len(t))
+    relay = np.empty(len(t))
+    on = False
+    for i, now[0] in enumerate(t):
+        humidity[i] = chamber.read()[1]
+        # Hysteresis between 80 and 88 %RH.
+        on = humidity[i] < 80 or (on and humidity[i] < 88)
+        chamber.set_relay(on)
+        relay[i] = on
+    model = control.fit_fopdt(t, humidity, relay)
+    assert model.gain == pytest.approx(0.05, rel=0.1)
+    assert model.tau == pytest.approx(900.0, rel=0.1)
+    assert model.dead_time == pytest.approx(20.0, abs=2.0)
+    assert model.ambient == pytest.approx(55.0, abs=2.0)
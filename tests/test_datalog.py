@@ -0,0 +1,120 @@
+import sqlite3
+import time
+
+import pytest
+
+import datalog
+import gorilla
+
+HOUR = datalog.ROLLUP_1H
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = datalog.connect(str(tmp_path / 'datalog.db'))
+    yield conn
+    conn.close()
+
+
+def fill(conn, start, hours, period=2000):
+    samples = [(ts, 20.0 + ts % 7, 85.0 + ts % 11, 92.0, 0)
+               for ts in range(start, start + hours * HOUR, period)]
+    with conn:
+        datalog.insert_samples(conn, samples)
+        # A NULL, as old databases have.
+        conn.execute("UPDATE temps SET temp = NULL WHERE ts = ?", (samples[3][0],))
+    samples[3] = samples[3][:1] + (None,) + samples[3][2:]
+    return [s[:4] for s in samples]
+
+
+def test_archive_keeps_rows(conn):
+    start = 1558310400000
+    rows = fill(conn, start, 5)
+    with conn:
+        moved = datalog.archive_rows(conn, start + 3 * HOUR)
+    assert moved == 3 * HOUR // 2000
+    assert conn.execute("SELECT count(*) FROM archive_chunks").fetchone()[0] == 3
+    assert datalog.get_range(conn, start, start + 5 * HOUR) == rows
+    # Ranges inside and across chunks.
+    assert datalog.get_range(conn, start + 1800000, start + 2 * HOUR) == \
+        [r for r in rows if start + 1800000 <= r[0] < start + 2 * HOUR]
+    assert datalog.get_range(conn, start + 2 * HOUR + 5, start + 4 * HOUR - 5) == \
+        [r for r in rows if start + 2 * HOUR + 5 <= r[0] < start + 4 * HOUR - 5]
+    assert datalog.get_rows(conn, 10) == rows[-10:]
+
+
+def test_archive_checks_chunks(conn, monkeypatch):
+    start = 1558310400000
+    rows = fill(conn, start, 2)
+    encode = gorilla.encode
+    monkeypatch.setattr(gorilla, 'encode', lambda rows: encode(rows[:-1]))
+    with pytest.raises(datalog.ArchiveError):
+        with conn:
+            datalog.archive_rows(conn, start + 2 * HOUR)
+    assert conn.execute("SELECT count(*) FROM archive_chunks").fetchone()[0] == 0
+    assert datalog.get_range(conn, start, start + 2 * HOUR) == rows
+
+
+def test_migrates_baseline_database(tmp_path):
+    # The table the original controller created and wrote to.
+    path = str(tmp_path / 'baseline.db')
+    legacy = sqlite3.connect(path)
+    legacy.execute("CREATE TABLE temps (timestamp DATETIME, temp NUMERIC,"
+                   " humidity NUMERIC, setpoint NUMERIC)")
+    legacy.executemany("INSERT INTO temps VALUES (?, ?, ?, ?)", [
+        ('2019-05-20 00:59:55', 28, 33, 40),
+        ('2019-05-20 00:59:57', 28.5, 33.25, 40),
+        ('2019-05-20 01:00:00', 27, None, 92),
+        (None, 1, 2, 3),
+    ])
+    legacy.commit()
+    legacy.close()
+
+    conn = datalog.connect(path)
+    try:
+        assert datalog.schema_version(conn) == datalog.SCHEMA_VERSION == 5
+        first = 1558313995000
+        assert datalog.get_range(conn, 0) == [
+            (first, 28.0, 33.0, 40.0),
+            (first + 2000, 28.5, 33.25, 40.0),
+            (first + 5000, 27.0, None, 92.0),
+        ]
+        assert datalog.chamber_names(conn) == {0: 'main'}
+        assert conn.execute("SELECT humidity_var FROM temps").fetchall() == [(None,)] * 3
+        # The rollups were backfilled from the migrated rows.
+        assert datalog.get_rollups(conn, datalog.ROLLUP_1H, 0) == [
+            (first - first % datalog.ROLLUP_1H, 2, 28.25, 28.0, 28.5, 33.125, 33.0, 33.25,
+             40.0, 40.0, 40.0),
+            (first + 5000, 1, 27.0, 27.0, 27.0, None, None, None, 92.0, 92.0, 92.0),
+        ]
+        assert not datalog.migrate(conn)
+    finally:
+        conn.close()
+
+
+def test_writer_waits_after_failed_commit(tmp_path, monkeypatch):
+    writer = datalog.DataWriter(str(tmp_path / 'datalog.db'), batch_size=5,
+                                flush_interval=0.2, max_pending=50)
+    commit = writer._commit
+    failing = [True]
+
+    def flaky(conn, batch):
+        if failing[0]:
+            raise sqlite3.OperationalError('disk I/O error')
+        commit(conn, batch)
+    monkeypatch.setattr(writer, '_commit', flaky)
+    writer.start()
+    for i in range(100):
+        writer.add(20.0, 85.0, 92.0, ts=1000 * i)
+    time.sleep(0.5)
+    # One retry per interval, not one per loop pass.
+    assert 1 <= writer.retries <= 4
+    failing[0] = False
+    writer.close(5)
+    conn = datalog.connect(str(tmp_path / 'datalog.db'))
+    try:
+        # The backlog kept the newest max_pending samples.
+        assert [r[0] for r in datalog.get_range(conn, 0)] == [1000 * i for i in range(50, 100)]
+    finally:
+        conn.close()
+    assert writer.dropped == 50
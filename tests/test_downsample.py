@@ -0,0 +1,65 @@
+import math
+
+import numpy as np
+import pytest
+
+import downsample
+
+
+def sequential_lttb(x, y, n):
+    """Plain LTTB, one bucket at a time, with lttb()'s rules for NaNs."""
+    size = len(x)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    buckets = [range(edges[i], edges[i + 1]) for i in range(n - 2)]
+
+    def mean(bucket):
+        known = [y[i] for i in bucket if not math.isnan(y[i])]
+        return (sum(x[i] for i in bucket) / len(bucket),
+                sum(known) / len(known) if known else math.nan)
+
+    kept = [0]
+    for b, bucket in enumerate(buckets):
+        cx, cy = mean(buckets[b + 1]) if b + 1 < len(buckets) else (x[-1], y[-1])
+        ax, ay = x[kept[-1]], y[kept[-1]]
+        if math.isnan(ay):
+            ay = mean(bucket)[1] if math.isnan(cy) else cy
+        if math.isnan(cy):
+            cy = ay
+        best, best_area = bucket[0], -1.0
+        for i in bucket:
+            area = abs((ax - cx) * (y[i] - ay) - (ax - x[i]) * (cy - ay))
+            if area > best_area:
+                best, best_area = i, area
+        kept.append(best)
+    return kept + [size - 1]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_sequential_lttb(seed):
+    rng = np.random.RandomState(seed)
+    x = np.cumsum(rng.uniform(1000, 3000, 2000))
+    y = np.cumsum(rng.normal(0, 1, 2000))
+    for n in (3, 10, 97, 500):
+        assert list(downsample.lttb(x, y, n)) == sequential_lttb(x, y, n)
+
+
+def test_nan_buckets():
+    rng = np.random.RandomState(1)
+    x = np.arange(1000.0)
+    y = np.sin(x / 50) + rng.normal(0, 0.1, 1000)
+    # Single failed reads, a gap longer than a bucket and a NaN first point.
+    y[[0, 5, 17, 333]] = np.nan
+    y[400:480] = np.nan
+    kept = downsample.lttb(x, y, 50)
+    assert list(kept) == sequential_lttb(x, y, 50)
+    edges = np.linspace(1, 999, 49).astype(int)
+    for pick, lo, hi in zip(kept[1:-1], edges[:-1], edges[1:]):
+        # A NaN is kept only from a bucket with nothing else.
+        assert not np.isnan(y[pick]) or np.isnan(y[lo:hi]).all()
+    assert np.isnan(y[kept[1:-1]]).sum() == 3
+
+
+def test_short_series():
+    assert list(downsample.lttb([0, 1, 2], [1, 2, 3], 5)) == [0, 1, 2]
+    with pytest.raises(ValueError):
+        downsample.lttb(range(10), range(10), 2)
@@ -0,0 +1,56 @@
+import pytest
+
+import filters
+
+
+def test_out_of_range_readings_are_dropped():
+    f = filters.SensorFilter(window=3, alpha=0.5)
+    assert f.value() is None
+    assert not f.update(22.0, 175.0)
+    assert not f.update(-50.0, 80.0)
+    assert f.value() is None
+    assert f.update(22.0, 80.0)
+    # A glitch neither moves the output nor enters the median window.
+    for reading in [(22.0, 175.0), (22.0, -1.0), (130.0, 80.0)]:
+        assert not f.update(*reading)
+        assert f.value() == (22.0, 80.0, 0.0, 0.0)
+    assert (f.accepted, f.rejected) == (1, 5)
+
+
+def test_median_removes_spikes():
+    f = filters.SensorFilter(window=3, alpha=1.0)
+    humidity = [80.0, 80.0, 95.0, 80.0, 80.0, 20.0, 80.0]
+    seen = []
+    for h in humidity:
+        f.update(22.0, h)
+        seen.append(f.value()[1])
+    assert seen == [80.0] * len(humidity)
+
+
+def test_ema_follows_a_step():
+    f = filters.SensorFilter(window=1, alpha=0.5)
+    seen = []
+    for h in [80.0, 90.0, 90.0, 90.0]:
+        f.update(22.0, h)
+        seen.append(f.value()[1])
+    assert seen == [80.0, 85.0, 87.5, 88.75]
+    assert f.value()[3] > 0
+
+
+def reading(h):
+    return filters.Filtered(22.0, h, 18.0, 0.0, 0.1)
+
+
+def test_interval_means_across_gaps():
+    means = filters.IntervalMean(1.0)
+    assert means.add(10.0, 1000, reading(80.0), True) is None
+    assert means.add(10.5, 1500, reading(82.0), False) is None
+    # Nothing for the seconds the sensor was silent, just the interval
+    # before them.
+    ts, values, relay, count = means.add(13.2, 4200, reading(90.0), True)
+    assert (ts, relay, count) == (1250, False, 2)
+    assert values.humidity == pytest.approx(81.0)
+    assert values.temperature == pytest.approx(22.0)
+    assert means.add(13.9, 4900, reading(92.0), True) is None
+    assert means.flush() == (4550, filters.Filtered(22.0, 91.0, 18.0, 0.0, 0.1), True, 2)
+    assert means.flush() is None
@@ -0,0 +1,51 @@
+import math
+import random
+
+import gorilla
+
+
+def round_trip(rows):
+    return gorilla.decode(gorilla.encode(rows))
+
+
+def test_empty():
+    assert round_trip([]) == []
+
+
+def test_regular_samples():
+    rng = random.Random(0)
+    rows = [(1558313995000 + 2000 * i + rng.randint(-30, 30),
+             20 + rng.gauss(0, 1), 85 + rng.gauss(0, 3), 92.0) for i in range(5000)]
+    assert round_trip(rows) == rows
+
+
+def test_repeated_values():
+    rows = [(1000 * i, 21.5, 88.0, 92.0) for i in range(100)]
+    assert round_trip(rows) == rows
+
+
+def test_none_nan_and_inf():
+    rows = [(0, None, 88.0, 92.0), (2000, float('nan'), None, 92.0),
+            (4000, float('inf'), -float('inf'), None), (6000, -0.0, 5e-324, 1.7976931348623157e308)]
+    decoded = round_trip(rows)
+    # NaN is how NULL is stored, so it comes back as None.
+    assert decoded == [(0, None, 88.0, 92.0), (2000, None, None, 92.0), rows[2], rows[3]]
+    assert math.copysign(1, decoded[3][1]) == -1
+
+
+def test_timestamp_gaps():
+    # Every delta-of-delta width, jumps back and a gap of years.
+    deltas = [0, 1, 63, -64, 64, 255, -256, 256, 2047, -2048, 2048, 10 ** 6,
+              -(10 ** 6), 3 * 365 * 86400 * 1000, 2000, 2000]
+    ts = 1558313995000
+    rows = []
+    for i, delta in enumerate(deltas):
+        ts += delta
+        rows.append((ts, float(i), 80.0 + i, 92.0))
+    assert round_trip(rows) == rows
+
+
+def test_iter_decode_stops_early():
+    rows = [(1000 * i, float(i), 88.0, 92.0) for i in range(50)]
+    decoded = gorilla.iter_decode(gorilla.encode(rows))
+    assert [next(decoded) for _ in range(3)] == rows[:3]
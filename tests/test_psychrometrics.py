@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import psychrometrics
+import simulation
+
+
+def test_dewpoint_matches_htu21d():
+    sensor = simulation.make_sensor(simulation.Chamber())
+    t, h = np.meshgrid(np.linspace(-30, 60, 37), np.linspace(1, 100, 34))
+    expected = [[sensor.dewpoint(ti, hi) for ti, hi in zip(*row)] for row in zip(t, h)]
+    np.testing.assert_allclose(psychrometrics.dewpoint(t, h), expected, rtol=1e-12, atol=1e-12)
+    # Single readings, as the controller passes them.
+    assert float(psychrometrics.dewpoint(22.0, 80.0)) == pytest.approx(sensor.dewpoint(22.0, 80.0))
+
+
+def test_dewpoint_without_humidity():
+    assert np.isnan(psychrometrics.dewpoint([22.0, 22.0], [0.0, -1.0])).all()
+
+
+def test_saturated_air():
+    assert float(psychrometrics.dewpoint(25.0, 100.0)) == pytest.approx(25.0)
+    assert float(psychrometrics.vapour_pressure_deficit(25.0, 100.0)) == 0.0
+    # About 23 g/m^3 of water in saturated air at 25 degrees C.
+    assert float(psychrometrics.absolute_humidity(25.0, 100.0)) == pytest.approx(23.0, abs=0.2)
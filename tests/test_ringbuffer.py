@@ -0,0 +1,67 @@
+import ringbuffer
+
+
+def sample(i):
+    return (1000 * i, float(i), 80.0 + i, 92.0)
+
+
+def filled(capacity, n):
+    ring = ringbuffer.SampleRing(capacity)
+    ring.extend(sample(i) for i in range(n))
+    return ring
+
+
+def test_wraparound():
+    ring = filled(10, 25)
+    assert ring.count == 25
+    assert ring.rows() == [sample(i) for i in range(15, 25)]
+    assert ring.rows(limit=3) == [sample(i) for i in range(22, 25)]
+    assert [tuple(r) for r in ring.columns()] == ring.rows()
+
+
+def test_since_across_the_wrap():
+    ring = filled(10, 25)
+    # Samples 15 .. 24 sit in slots 4 .. 10 and 0 .. 2.
+    for since in range(15, 25):
+        assert ring.rows(since=1000 * since) == [sample(i) for i in range(since + 1, 25)]
+    assert ring.rows(since=1000 * 20 + 500, limit=2) == [sample(23), sample(24)]
+    assert ring.rows(since=1000 * 24) == []
+
+
+def test_since_older_than_the_oldest_kept():
+    ring = filled(10, 25)
+    assert ring.rows(since=1000 * 3) == [sample(i) for i in range(15, 25)]
+    assert ring.rows(since=-1) == ring.rows()
+
+
+class LappedRing(ringbuffer.SampleRing):
+    """Appends pending samples while a reader is copying, as a writer in
+    another process could."""
+
+    pending = ()
+
+    def _offset(self, i):
+        pending, self.pending = self.pending, ()
+        self.extend(pending)
+        return super(LappedRing, self)._offset(i)
+
+
+def test_reader_lapped_during_read():
+    ring = LappedRing(10)
+    ring.extend(sample(i) for i in range(25))
+    ring.pending = [sample(i) for i in range(25, 29)]
+    rows = ring.rows()
+    # Only samples the writer could not have touched are returned.
+    assert rows and rows == [sample(i) for i in range(25 - len(rows), 25)]
+    assert rows[0][0] >= 1000 * (29 - 10)
+    ring.pending = [sample(i) for i in range(29, 31)]
+    columns = ring.columns()
+    assert [tuple(r) for r in columns] == [sample(i) for i in range(29 - len(columns), 29)]
+    assert columns[0]['ts'] >= 1000 * (31 - 10)
+
+
+def test_empty():
+    ring = ringbuffer.SampleRing(10)
+    assert ring.rows() == []
+    assert ring.rows(since=0) == []
+    assert len(ring.columns()) == 0
@@ -1,62 +1,488 @@
 '''
 Humidity Controller web app
 
+Recent samples come from the controller's shared ring buffers. Older
+history (/data?start=&end=) is read from the SQLite data log, or the
+sample logs with HUMIDITY_STORAGE=samplelog, and downsampled on the
+server, so any range costs about the same to send and draw. ?derived=
+adds series computed from temperature and humidity (see
+psychrometrics.py) to either. /stream pushes new samples to open pages
+as Server-Sent Events.
 '''
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, g, render_template, request
+import collections
 import json
+import os
+import queue
+import sqlite3
+import struct
+import threading
 import time
 
+import numpy as np
 
-def get_rows(queue):
-    rows = queue.get()
-    return rows
+import datalog
+import downsample
+import metrics
+import psychrometrics
+import samplelog
+from webpage import assets
 
-def create_app(queue):
-    app = Flask(__name__, template_folder="/home/pi/webpage/")
-    app.config['QUEUE'] = queue
-    return app
 
-def launch_app(queue):
-    app = create_app(queue)
+WINDOW = 1000
+
+# History requests return at most max_points points per series (default
+# DEFAULT_POINTS, at most MAX_POINTS). Raw samples are downsampled when a
+# range has up to OVERSAMPLE times that many of them; longer ranges use
+# the coarsest rollup tier that still gives enough points to choose from.
+DEFAULT_POINTS = 1000
+MAX_POINTS = 5000
+OVERSAMPLE = 10
+
+# Plotted series and their column in sample rows. /data?derived=a,b adds
+# those of psychrometrics.DERIVED.
+SERIES = (('temp', 1), ('humidity', 2))
+
+# /data answers with pack_columns() instead of JSON when asked for this
+# type in Accept, or with ?format=binary.
+BINARY_MIMETYPE = 'application/vnd.humidity.columns'
+BINARY_HEADER = struct.Struct('<IIddd')
+BINARY_COUNT = struct.Struct('<I')
+
+# Serialized /data bodies kept for reuse, see BodyCache.
+DATA_CACHE_SIZE = 64
+
+# /stream checks the rings for new samples every STREAM_POLL_INTERVAL
+# seconds, queues at most STREAM_QUEUE_SIZE events per client and sends
+# a keepalive comment after STREAM_KEEPALIVE idle seconds.
+STREAM_POLL_INTERVAL = 0.1
+STREAM_QUEUE_SIZE = 16
+STREAM_KEEPALIVE = 15.0
+
+# HUMIDITY_WEB_PORT overrides the port, e.g. to run unprivileged off the Pi.
+PORT = int(os.environ.get('HUMIDITY_WEB_PORT', 80))
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    'http_request_duration_seconds', 'Web request latency by route.', ['route'])
+REQUESTS = metrics.Counter(
+    'http_requests_total', 'Web requests by route and status code.', ['route', 'status'])
+ROWS_READ_SECONDS = metrics.Histogram(
+    'rows_read_seconds', 'Time to snapshot recent rows from the ring buffer.')
+HISTORY_READ_SECONDS = metrics.Histogram(
+    'history_read_seconds', 'Time to read and downsample a history range from the data log.')
+DATA_CACHE_HITS = metrics.Counter(
+    'data_cache_hits_total', '/data responses served as 304 or from the body cache.', ['kind'])
+STREAM_CLIENTS = metrics.Gauge(
+    'stream_clients', 'Open /stream connections.')
+STREAM_EVENTS = metrics.Counter(
+    'stream_events_total', 'Sample events broadcast to /stream clients (counted once per event).')
+STREAM_RESYNCS = metrics.Counter(
+    'stream_resyncs_total', 'Times a slow /stream client fell behind and was told to reload.')
+
+
+def get_rows(ring, since=None):
+    """Snapshot of the controller's recent rows from the shared ring
+    buffer, optionally only those newer than the since cursor."""
+    with ROWS_READ_SECONDS.time():
+        return ring.rows(since=since, limit=WINDOW)
+
+def parse_derived(value):
+    """The derived series named in a comma separated ?derived= value, or
+    None if any is unknown."""
+    names = tuple(name for name in (value or '').split(',') if name)
+    if any(name not in psychrometrics.DERIVED for name in names):
+        return None
+    return names
+
+def derive(temp, humidity, derived):
+    """{name: values} of the derived series for arrays of temperature and
+    humidity."""
+    return collections.OrderedDict(
+        (name, psychrometrics.DERIVED[name](temp, humidity)) for name in derived)
+
+def pairs(ts, values):
+    """[timestamp, value] pairs, None for NaN values."""
+    return [[t, None if v != v else v] for t, v in zip(ts.tolist(), values.tolist())]
+
+def series(rows, cursor=None, derived=()):
+    """Plot data for rows: a cursor for the next delta request and
+    [timestamp, value] pairs for each series."""
+    data = {
+        'cursor': rows[-1][0] if rows else cursor,
+        'temp': [[row[0], row[1]] for row in rows],
+        'humidity': [[row[0], row[2]] for row in rows],
+    }
+    if derived:
+        values = np.array(rows, dtype=float).reshape(-1, 4)
+        ts = values[:, 0].astype(np.int64)
+        for name, column in derive(values[:, 1], values[:, 2], derived).items():
+            data[name] = pairs(ts, column)
+    return data
+
+def live_columns(ring, since=None, derived=()):
+    """Like get_rows(), as {series: (timestamps, values)} NumPy arrays,
+    and the cursor for the next delta request."""
+    with ROWS_READ_SECONDS.time():
+        samples = ring.columns(since=since, limit=WINDOW)
+    cursor = int(samples['ts'][-1]) if len(samples) else since
+    columns = collections.OrderedDict(
+        (name, (samples['ts'], samples[name])) for name, column in SERIES)
+    for name, values in derive(samples['temp'], samples['humidity'], derived).items():
+        columns[name] = (samples['ts'], values)
+    return columns, cursor
+
+def history_columns(conn, start, end, max_points, chamber=0, derived=(), store=None):
+    """Plot data for start <= ts < end from the data log as
+    {series: (timestamps, values)} NumPy arrays, with at most max_points
+    points per series, and the resolution they have.
+
+    The resolution is 0 for raw samples, else the rollup period (in ms)
+    whose bucket means were used; derived series are then computed from
+    the bucket means of temperature and humidity. With store, a
+    samplelog.SampleLogStore, the raw samples are read from its logs
+    instead, which have no rollups: a range with more than OVERSAMPLE
+    times max_points of them is thinned to every nth sample first.
+    """
+    budget = OVERSAMPLE * max_points
+    resolution = 0
+    rows = None
+    if store is not None:
+        records = store.array(start, end, chamber)
+        # A strided view of the mapping; only the samples kept are read.
+        records = records[::-(-len(records) // budget) or 1]
+        values = np.column_stack([records[name].astype(float)
+                                  for name in ('ts', 'temp', 'humidity', 'setpoint')])
+    elif (end - start) // datalog.ROLLUP_1M <= budget and \
+            datalog.count_samples(conn, start, end, chamber) <= budget:
+        rows = datalog.get_range(conn, start, end, chamber)
+    else:
+        # The coarsest tier with at least max_points / 2 buckets in the
+        # range, or the finest.
+        for resolution in reversed(datalog.ROLLUP_PERIODS):
+            if (end - start) // resolution >= max_points // 2:
+                break
+        # Bucket means of temp, humidity and setpoint, at the middle of
+        # each bucket.
+        rows = [(r[0] + resolution // 2, r[2], r[5], r[8])
+                for r in datalog.get_rollups(conn, resolution, start, end, chamber)]
+    if rows is not None:
+        values = np.array(rows, dtype=float).reshape(-1, 4)
+    full = collections.OrderedDict((name, values[:, column]) for name, column in SERIES)
+    full.update(derive(values[:, 1], values[:, 2], derived))
+    columns = collections.OrderedDict()
+    for name, column in full.items():
+        keep = downsample.lttb(values[:, 0], column, max_points) if len(values) else []
+        columns[name] = (values[keep, 0].astype(np.int64), column[keep])
+    return columns, resolution
+
+def history(conn, start, end, max_points, chamber=0, derived=(), store=None):
+    """history_columns() as JSON ready plot data."""
+    columns, resolution = history_columns(conn, start, end, max_points, chamber, derived,
+                                          store)
+    data = {'start': start, 'end': end, 'resolution': resolution, 'cursor': None}
+    for name, (ts, values) in columns.items():
+        data[name] = pairs(ts, values)
+    return data
+
+def pack_columns(columns, cursor=None, resolution=0):
+    """The binary /data format, all little-endian:
+
+        header:     series count (uint32), time unit in ms (uint32),
+                    base time in epoch ms, cursor (NaN if none) and
+                    resolution (float64)
+        per series: point count n (uint32), n times as int32 offsets from
+                    the base in time units, n float32 values (NaN for
+                    missing ones)
+
+    Series are in SERIES order, followed by any derived series in the
+    order they were asked for. The time unit is 1 ms unless the span
+    does not fit in an int32, then 1 s, and so on.
+    """
+    times = [ts for ts, values in columns.values() if len(ts)]
+    base = min(int(ts[0]) for ts in times) if times else 0
+    span = max(int(ts[-1]) for ts in times) - base if times else 0
+    unit = 1
+    while span // unit >= 2 ** 31:
+        unit *= 1000
+    parts = [BINARY_HEADER.pack(len(columns), unit, base,
+                                float('nan') if cursor is None else cursor, resolution)]
+    for ts, values in columns.values():
+        parts.append(BINARY_COUNT.pack(len(ts)))
+        parts.append(((ts - base) // unit).astype('<i4').tobytes())
+        parts.append(values.astype('<f4').tobytes())
+    return b''.join(parts)
+
+class BodyCache(object):
+    """Serialized response bodies, each valid for one ring sequence number.
+
+    /data?since=<cursor> responses only change when the controller appends
+    a sample, so the body built for one viewer is reused for every other
+    viewer polling with the same cursor until the ring's count moves on.
+    """
+
+    def __init__(self, size=DATA_CACHE_SIZE):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+def sse(event, data, event_id=None):
+    """One Server-Sent Events message."""
+    lines = [] if event_id is None else ['id: {}'.format(event_id)]
+    lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(data))
+    return '\n'.join(lines) + '\n\n'
+
+# Sent to a client whose queue overflowed, in place of the events it
+# missed. The page reloads the window from /data.
+RESYNC = sse('resync', '{}')
+
+class Broadcaster(object):
+    """Fans new samples out to /stream clients.
+
+    One thread polls every chamber's ring for new samples and formats each
+    batch into an event once; each client gets it through its own bounded
+    queue. A client that does not keep up (its queue is full) has its
+    backlog replaced by a single resync event, so a slow client costs a
+    fixed amount of memory and never holds up the others.
+
+    The thread starts with the first client, in the web process.
+    """
+
+    def __init__(self, rings, poll_interval=STREAM_POLL_INTERVAL, queue_size=STREAM_QUEUE_SIZE):
+        self.rings = rings
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self._clients = dict((name, set()) for name in rings)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, chamber):
+        q = queue.Queue(self.queue_size)
+        with self._lock:
+            self._clients[chamber].add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Broadcaster', daemon=True)
+                self._thread.start()
+        STREAM_CLIENTS.inc()
+        return q
+
+    def unsubscribe(self, chamber, q):
+        with self._lock:
+            self._clients[chamber].discard(q)
+        STREAM_CLIENTS.inc(-1)
+
+    def _publish(self, chamber, message):
+        with self._lock:
+            clients = list(self._clients[chamber])
+        for q in clients:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Drop the backlog; put the resync in its place.
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(RESYNC)
+                STREAM_RESYNCS.inc()
+
+    def _run(self):
+        counts = dict((name, ring.count) for name, ring in self.rings.items())
+        cursors = {}
+        for name, ring in self.rings.items():
+            rows = ring.rows(limit=1)
+            cursors[name] = rows[-1][0] if rows else None
+        while True:
+            time.sleep(self.poll_interval)
+            for name, ring in self.rings.items():
+                count = ring.count
+                if count == counts[name]:
+                    continue
+                counts[name] = count
+                rows = get_rows(ring, cursors[name])
+                if not rows:
+                    continue
+                cursors[name] = rows[-1][0]
+                data = series(rows)
+                self._publish(name, sse('samples', json.dumps(data), data['cursor']))
+                STREAM_EVENTS.inc()
+
+def create_app(rings, db_path=None, samplelog_dir=None):
+    """rings maps chamber names to their SampleRing, first chamber first.
+    db_path is the data log chambers are named in and history is read
+    from, unless samplelog_dir names the sample log directory the
+    controller writes to instead."""
+    app = Flask(__name__, template_folder=os.path.dirname(os.path.abspath(__file__)))
+    app.config['RINGS'] = rings
+    app.config['DB_PATH'] = db_path
+    store = samplelog.SampleLogStore(samplelog_dir, readonly=True) if samplelog_dir else None
+    # Ring counts start over when the controller restarts (and this app
+    # with it), so ETags also carry a token for this start.
+    boot_id = os.urandom(4).hex()
+    broadcaster = Broadcaster(rings)
+    bodies = BodyCache()
+    assets.init_app(app)
+
+    def db():
+        # A read-only connection per request; the controller owns writes
+        # and migrations.
+        if 'db' not in g:
+            if app.config['DB_PATH'] is None:
+                abort(404)
+            g.db = sqlite3.connect('file:{}?mode=ro'.format(app.config['DB_PATH']), uri=True)
+        return g.db
+
+    @app.teardown_appcontext
+    def close_db(exception):
+        conn = g.pop('db', None)
+        if conn is not None:
+            conn.close()
+
+    def chamber_ring():
+        # ?chamber=<name> picks the chamber, the first one by default.
+        rings = app.config['RINGS']
+        chamber = request.args.get('chamber', next(iter(rings)))
+        if chamber not in rings:
+            abort(404)
+        return chamber, rings[chamber]
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - g.request_start)
+        REQUESTS.labels(route, response.status_code).inc()
+        return response
 
     @app.route("/")
     def main():
-        queue = app.config['QUEUE']
-        rows = get_rows(queue)
-        rows = rows[-1000:]
-        tick = 1
-        temps = []
-        humidity = []
-        for row in rows:
-            #print(row)
-            temps.append([tick, row[1]])
-            humidity.append([tick, row[2]])
-            tick +=1
-
-        data = ("[ { label: \'Temp\', data: " + str(temps) + " }," +
-                "  { label: \'Humidity\', data: " + str(humidity) + " }]")
-        options = ""#("{legend: { show: true, container: '#legendholder' }}")
-        return render_template("main.html", data=data, options=options)
+        chamber, ring = chamber_ring()
+        rows = get_rows(ring)
+        data = json.dumps(series(rows))
+        return render_template("main.html", data=data, window=WINDOW,
+                               chamber=chamber, chambers=list(app.config['RINGS']))
 
     @app.route("/data")
     def data():
+        # With ?since=<cursor> only the rows recorded after the cursor from
+        # the previous response are returned. With ?start=<ms>[&end=<ms>]
+        # [&max_points=<n>] the range is read from the data log instead.
+        # ?format=binary or an Accept of BINARY_MIMETYPE gets the binary
+        # format of pack_columns(). ?derived=dewpoint,absolute_humidity,vpd
+        # adds any of those series.
+        chamber, ring = chamber_ring()
+        derived = parse_derived(request.args.get('derived'))
+        if derived is None:
+            abort(400)
+        binary = (request.args.get('format') == 'binary' or
+                  request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE])
+                  == BINARY_MIMETYPE)
+        start = request.args.get('start', type=int)
+        if start is not None:
+            end = request.args.get('end', type=int) or datalog.now_ms()
+            max_points = min(max(request.args.get('max_points', DEFAULT_POINTS, type=int), 3),
+                             MAX_POINTS)
+            if end <= start:
+                abort(400)
+            conn = db()
+            ids = dict((name, i) for i, name in datalog.chamber_names(conn).items())
+            with HISTORY_READ_SECONDS.time():
+                if binary:
+                    columns, resolution = history_columns(conn, start, end, max_points,
+                                                          ids.get(chamber, -1), derived, store)
+                    return Response(pack_columns(columns, None, resolution),
+                                    mimetype=BINARY_MIMETYPE, headers={'Vary': 'Accept'})
+                result = history(conn, start, end, max_points, ids.get(chamber, -1), derived,
+                                 store)
+            return Response(json.dumps(result), mimetype='application/json',
+                            headers={'Vary': 'Accept'})
+
+        # Versioned by the ring's sequence number, read before the rows so
+        # a response never claims to be newer than its contents.
+        since = request.args.get('since', type=int)
+        version = ring.count
+        etag = '{}-{}'.format(boot_id, version) + ('.bin' if binary else '')
+        mimetype = BINARY_MIMETYPE if binary else 'application/json'
+        if request.if_none_match.contains(etag):
+            DATA_CACHE_HITS.labels('not_modified').inc()
+            response = Response(status=304)
+        else:
+            key = (chamber, since, binary, derived)
+            body = bodies.get(key, version)
+            if body is None:
+                if binary:
+                    body = pack_columns(*live_columns(ring, since, derived))
+                else:
+                    body = json.dumps(series(get_rows(ring, since), since, derived))
+                bodies.put(key, version, body)
+            else:
+                DATA_CACHE_HITS.labels('body').inc()
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept'
+        # Browsers may keep the body but must revalidate it every time.
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @app.route("/stream")
+    def stream():
+        # Server-Sent Events: a 'samples' event with the same payload as a
+        # /data?since= response whenever the controller records samples.
+        # A reconnecting browser sends the last cursor it saw as
+        # Last-Event-ID and first gets what it missed.
+        chamber, ring = chamber_ring()
+        last_id = request.headers.get('Last-Event-ID', type=int)
+
+        def events():
+            q = broadcaster.subscribe(chamber)
+            try:
+                yield 'retry: 2000\n\n'
+                if last_id is not None:
+                    rows = get_rows(ring, last_id)
+                    if rows:
+                        data = series(rows)
+                        yield sse('samples', json.dumps(data), data['cursor'])
+                while True:
+                    try:
+                        yield q.get(timeout=STREAM_KEEPALIVE)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+            finally:
+                broadcaster.unsubscribe(chamber, q)
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route("/metrics")
+    def metrics_page():
+        return Response(metrics.REGISTRY.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return app
 
-        queue = app.config['QUEUE']
-        rows = get_rows(queue)
-        rows = rows[-1000:]
-        tick = 1
-        temps = []
-        humidity = []
-        for row in rows:
-            #print(row)
-            temps.append([tick, row[1]])
-            humidity.append([tick, row[2]])
-            tick +=1
-
-        json_string = json.dumps([temps, humidity])
-        return json_string
-
-    app.run(host='0.0.0.0', port=80, threaded=True)
+def launch_app(rings, db_path=None, samplelog_dir=None):
+    app = create_app(rings, db_path, samplelog_dir)
+    app.run(host='0.0.0.0', port=PORT, threaded=True)
 
 if __name__ == "__main__":
     launch_app()
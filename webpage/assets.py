@@ -0,0 +1,125 @@
+'''
+Precompressed, content-hashed static assets for the web app.
+
+    python -m webpage.assets
+
+copies every .js and .css file under webpage/static into
+webpage/static/dist with a hash of its contents in the name
+(js/jquery.js becomes js/jquery.<hash>.js), writes gzip and, if the
+brotli module is installed, brotli compressed copies next to each, and
+records the names in dist/manifest.json. Re-run it after changing a
+file.
+
+The app serves built files at /assets/ in the best encoding the browser
+accepts, cached for a year without revalidation: a changed file gets a
+new name. Templates link assets with asset_url(filename), which falls
+back to the plain static URL for anything that has not been built.
+'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import abort, request, send_file, url_for
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+EXTENSIONS = ('.js', '.css')
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Encodings in order of preference: (Accept-Encoding name, file suffix).
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def hashed_name(filename, data):
+    root, ext = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """Builds dist_dir from static_dir and returns the manifest."""
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist_dir]
+        for name in sorted(files):
+            if not name.endswith(EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            target = hashed_name(filename, data)
+            out = os.path.join(dist_dir, target)
+            if not os.path.isdir(os.path.dirname(out)):
+                os.makedirs(os.path.dirname(out))
+            with open(out, 'wb') as f:
+                f.write(data)
+            with open(out + '.gz', 'wb') as f:
+                # mtime=0 keeps the output identical between builds.
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f, compresslevel=9, mtime=0) as gz:
+                    gz.write(data)
+            if brotli is not None:
+                with open(out + '.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+            manifest[filename] = target
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """{static filename: hashed filename}, empty if nothing was built."""
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def init_app(app, dist_dir=DIST_DIR):
+    """Adds the /assets/ route and the asset_url() template function."""
+    manifest = load_manifest(dist_dir)
+
+    def asset_url(filename):
+        if filename in manifest:
+            return url_for('asset', filename=manifest[filename])
+        return url_for('static', filename=filename)
+
+    @app.route('/assets/<path:filename>')
+    def asset(filename):
+        path = safe_join(dist_dir, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(path + suffix):
+                path += suffix
+                encoding = name
+                break
+        response = send_file(path, mimetype=mimetype, conditional=True)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
+
+    app.jinja_env.globals['asset_url'] = asset_url
+    return manifest
+
+
+if __name__ == "__main__":
+    manifest = build()
+    print("Built {} assets in {}{}.".format(
+        len(manifest), DIST_DIR, '' if brotli is not None else ' (gzip only, no brotli module)'))